@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# Server Bot API finto per i benchmark: risponde ai metodi usati dal bot con messaggi sintetici,
+# con latenza configurabile, banda di upload limitata e iniezione di errori 429 (flood control).
+#
+# Oltre ai metodi della Bot API espone:
+# - GET /_bench/events: reazioni ricevute (il driver le usa per misurare la latenza end-to-end)
+# - GET /_bench/stats: chiamate per metodo, errori 429 iniettati e byte ricevuti
+# - GET /_bench/media/<byte>/<nome>: file sintetico della dimensione indicata (i media degli album dello stub di gallery-dl)
+#
+# Uso: python bench/fake_bot_api.py --port 8081 --latency 0.05 --error-rate 0.02
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl, urlsplit
+
+class FakeBotApi:
+    """Stato del server finto: contatori, reazioni ricevute e generatori di id."""
+
+    def __init__(self, latency, upload_rate, error_rate, retry_after, seed):
+        self.latency = latency
+        self.upload_rate = upload_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.message_ids = itertools.count(1_000_000)
+        self.file_ids = itertools.count(1)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.bytes_received = 0
+        self.events = []
+
+    @staticmethod
+    def parse_body(headers, body):
+        """Parametri della richiesta: JSON, form urlencoded o multipart (con i file ignorati)."""
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if name and part.get_filename() is None:
+                    # I campi testuali sono UTF-8 senza charset dichiarato, come li inviano i client della Bot API
+                    params[name] = part.get_payload(decode=True).decode().strip()
+            return params
+        return dict(parse_qsl(body.decode()))
+
+    @staticmethod
+    def json_param(params, name, default=None):
+        value = params.get(name, default)
+        if isinstance(value, str):
+            try:
+                return json.loads(value)
+            except ValueError:
+                return value
+        return value
+
+    def file(self, **extra):
+        number = next(self.file_ids)
+        return {"file_id": f"bench-file-{number}", "file_unique_id": f"bench-unique-{number}", **extra}
+
+    def message(self, params, **content):
+        chat_id = int(self.json_param(params, "chat_id", 0))
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+        }
+        caption = params.get("caption")
+        if caption:
+            message["caption"] = caption
+        message.update(content)
+        return message
+
+    def media_message(self, params, media_type, caption=None):
+        if caption is not None:
+            params = {**params, "caption": caption}
+        if media_type == "photo":
+            return self.message(params, photo=[self.file(width=1280, height=720)])
+        if media_type == "video":
+            return self.message(params, video=self.file(width=1280, height=720, duration=60))
+        if media_type == "audio":
+            return self.message(params, audio=self.file(duration=180))
+        return self.message(params, document=self.file())
+
+    def result(self, method, params):
+        """Risultato sintetico del metodo richiesto."""
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method in ("sendMessage", "editMessageText"):
+            return self.message(params, text=params.get("text", ""))
+        if method == "sendVideo":
+            return self.media_message(params, "video")
+        if method == "sendAudio":
+            return self.media_message(params, "audio")
+        if method == "sendDocument":
+            return self.media_message(params, "document")
+        if method == "sendPhoto":
+            return self.media_message(params, "photo")
+        if method == "sendMediaGroup":
+            media = self.json_param(params, "media", [])
+            return [self.media_message(params, item.get("type"), item.get("caption")) for item in media]
+        if method == "setMessageReaction":
+            reaction = self.json_param(params, "reaction", []) or []
+            emoji = reaction[0].get("emoji") if reaction and isinstance(reaction[0], dict) else reaction
+            self.events.append({
+                "time": time.time(),
+                "chat_id": int(self.json_param(params, "chat_id", 0)),
+                "message_id": int(self.json_param(params, "message_id", 0)),
+                "emoji": emoji,
+            })
+        return True
+
+    async def handle(self, method, path, headers, body):
+        """Restituisce (stato, corpo JSON) per una richiesta HTTP."""
+        if path == "/_bench/events":
+            return 200, {"events": self.events}
+        if path == "/_bench/stats":
+            return 200, {"calls": self.calls, "errors_429": self.errors, "bytes_received": self.bytes_received}
+        if path.startswith("/_bench/media/"):
+            self.calls["media"] += 1
+            await asyncio.sleep(self.latency)
+            return 200, random.randbytes(int(path.split("/")[3]))
+        api_method = path.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        self.bytes_received += len(body)
+        delay = self.latency
+        if self.upload_rate:
+            delay += len(body) / self.upload_rate
+        await asyncio.sleep(delay)
+        if api_method != "getMe" and self.random.random() < self.error_rate:
+            self.errors[api_method] += 1
+            return 429, {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        try:
+            params = self.parse_body(headers, body)
+        except Exception as e:
+            return 400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+        return 200, {"ok": True, "result": self.result(api_method, params)}
+
+    @staticmethod
+    async def read_chunked(reader):
+        """Corpo inviato con Transfer-Encoding: chunked (upload in streaming senza dimensione nota)."""
+        parts = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()  # Riga vuota finale (senza trailer)
+                return b"".join(parts)
+            parts.append(await reader.readexactly(size))
+            await reader.readline()
+
+    async def serve_connection(self, reader, writer):
+        """Gestisce le richieste di una connessione keep-alive."""
+        try:
+            while True:
+                request_line = (await reader.readline()).decode("latin-1").split()
+                if len(request_line) < 2:
+                    break
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if headers.get("transfer-encoding", "").lower() == "chunked":
+                    body = await self.read_chunked(reader)
+                else:
+                    body = await reader.readexactly(int(headers.get("content-length", "0")))
+                status, payload = await self.handle(request_line[0], urlsplit(request_line[1]).path, headers, body)
+                if isinstance(payload, bytes):
+                    data, content_type = payload, "application/octet-stream"
+                else:
+                    data, content_type = json.dumps(payload).encode(), "application/json"
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+async def main():
+    parser = argparse.ArgumentParser(description="Server Bot API finto per i benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05, help="secondi di latenza per ogni chiamata")
+    parser.add_argument("--upload-rate", type=float, default=0, help="banda di upload simulata in byte/s (0 = illimitata)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probabilità di rispondere 429 a una chiamata")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after degli errori 429 iniettati")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.latency, args.upload_rate, args.error_rate, args.retry_after, args.seed)
+    server = await asyncio.start_server(api.serve_connection, args.host, args.port)
+    print(f"READY http://{args.host}:{server.sockets[0].getsockname()[1]}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# Benchmark di carico del bot senza rete: avvia il server Bot API finto, mette gli stub di yt-dlp/gallery-dl
+# nel PATH e passa N update sintetici a handle_message, misurando:
+# - messaggi al secondo
+# - latenza end-to-end (dall'update alla reazione finale 👌/💔) p50/p95/p99
+# - RSS massimo del bot e dei processi figli
+# - occupazione massima della cartella dei download e dimensione finale della cache su disco
+#
+# Esempi:
+#   python bench/run.py --messages 200 --chats 20
+#   python bench/run.py --messages 100 --unique 10 --error-rate 0.05 --json results.json
+#
+# Le impostazioni del bot (MAX_CONCURRENT_JOBS, CHAT_SEND_RATE, ...) si passano come variabili d'ambiente.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark di carico del bot con yt-dlp e Bot API finti")
+    parser.add_argument("--messages", type=int, default=100, help="update sintetici da inviare")
+    parser.add_argument("--chats", type=int, default=10, help="chat (e utenti) diversi tra cui distribuire i messaggi")
+    parser.add_argument("--unique", type=int, default=0, help="link distinti (0 = tutti diversi); valori bassi misurano le cache")
+    parser.add_argument("--links-per-message", type=int, default=1)
+    parser.add_argument("--audio-ratio", type=float, default=0.0, help="quota di messaggi in modalità audio")
+    parser.add_argument("--gallery-ratio", type=float, default=0.0, help="quota di link a post Instagram (gallery-dl)")
+    parser.add_argument("--playlist-ratio", type=float, default=0.0, help="quota di link a playlist")
+    parser.add_argument("--rate", type=float, default=0, help="messaggi al secondo in ingresso (0 = tutti insieme)")
+    parser.add_argument("--file-size", type=int, default=2 * 1024 * 1024, help="byte di ogni video scaricato")
+    parser.add_argument("--duration", type=int, default=60, help="durata dichiarata dei video in secondi")
+    parser.add_argument("--download-rate", type=float, default=20 * 1024 * 1024, help="velocità di download simulata in byte/s")
+    parser.add_argument("--latency", type=float, default=0.05, help="latenza della Bot API finta in secondi")
+    parser.add_argument("--upload-rate", type=float, default=0, help="banda di upload simulata in byte/s (0 = illimitata)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probabilità di errori 429 dalla Bot API finta")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600, help="secondi massimi di attesa dei job")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="salva i risultati in questo file JSON")
+    parser.add_argument("--keep", action="store_true", help="non eliminare la cartella temporanea del benchmark")
+    return parser.parse_args()
+
+def start_fake_api(args):
+    """Avvia il server Bot API finto su una porta libera e ne restituisce (processo, URL)."""
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "fake_bot_api.py"), "--port", "0",
+         "--latency", str(args.latency), "--upload-rate", str(args.upload_rate),
+         "--error-rate", str(args.error_rate), "--retry-after", str(args.retry_after), "--seed", str(args.seed)],
+        stdout=subprocess.PIPE, text=True
+    )
+    line = proc.stdout.readline().strip()
+    if not line.startswith("READY "):
+        proc.kill()
+        raise RuntimeError("il server Bot API finto non si è avviato")
+    return proc, line.split(" ", 1)[1]
+
+def fetch_json(url):
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.load(response)
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(fraction * (len(values) - 1))))
+    return round(values[index], 3)
+
+def build_texts(args):
+    """Testi dei messaggi sintetici, con la stessa sequenza a parità di seed."""
+    rng = random.Random(args.seed)
+    texts = []
+    link_number = 0
+    for _ in range(args.messages):
+        links = []
+        for _ in range(args.links_per_message):
+            n = link_number % args.unique if args.unique else link_number
+            link_number += 1
+            kind = rng.random()
+            if kind < args.gallery_ratio:
+                links.append(f"https://www.instagram.com/p/bench{n}/")
+            elif kind < args.gallery_ratio + args.playlist_ratio:
+                links.append(f"https://bench.example/playlist?list=bench{n}")
+            else:
+                links.append(f"https://bench.example/watch?v=bench{n}")
+        prefix = "audio " if rng.random() < args.audio_ratio else ""
+        texts.append(prefix + " ".join(links))
+    return texts
+
+async def run(args, api_url, workdir):
+    import bot
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder, CallbackContext
+
+    app = ApplicationBuilder().token(os.environ["BOT_TOKEN"]).base_url(f"{api_url}/bot").concurrent_updates(bot.CONCURRENT_UPDATES).build()
+    await app.initialize()
+    bot.dispatcher.start(app.bot)
+
+    texts = build_texts(args)
+    sent_at = {}  # (chat_id, message_id) -> istante di invio dell'update
+    peak_disk = 0
+    stop_sampling = asyncio.Event()
+
+    async def sample_disk():
+        nonlocal peak_disk
+        loop = asyncio.get_running_loop()
+        while not stop_sampling.is_set():
+            peak_disk = max(peak_disk, await loop.run_in_executor(None, directory_size, bot.DOWNLOAD_DIR))
+            try:
+                await asyncio.wait_for(stop_sampling.wait(), 0.2)
+            except asyncio.TimeoutError:
+                pass
+
+    sampler = asyncio.create_task(sample_disk())
+    started = time.time()
+    handlers = []
+    for i, text in enumerate(texts):
+        chat_id = 1000 + i % args.chats
+        message_id = i + 1
+        update = Update.de_json({
+            "update_id": i + 1,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+                "text": text,
+            },
+        }, app.bot)
+        sent_at[(chat_id, message_id)] = time.time()
+        handlers.append(asyncio.create_task(bot.handle_message(update, CallbackContext(app))))
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*handlers)
+
+    # Attende la reazione finale di ogni messaggio
+    finished = {}
+    deadline = time.time() + args.timeout
+    while len(finished) < len(sent_at) and time.time() < deadline:
+        await asyncio.sleep(0.2)
+        events = await asyncio.get_running_loop().run_in_executor(None, fetch_json, f"{api_url}/_bench/events")
+        for event in events["events"]:
+            key = (event["chat_id"], event["message_id"])
+            if event["emoji"] in ("👌", "💔") and key in sent_at and key not in finished:
+                finished[key] = (event["time"], event["emoji"])
+    elapsed = (max(t for t, _ in finished.values()) if finished else time.time()) - started
+    stop_sampling.set()
+    await sampler
+
+    stats = fetch_json(f"{api_url}/_bench/stats")
+    await bot.dispatcher.drain(5)
+    await app.shutdown()
+    bot.outbound.shutdown()
+    bot.scheduler.shutdown()
+
+    latencies = [finished[key][0] - sent_at[key] for key in finished]
+    return {
+        "messages": len(sent_at),
+        "completed": len(finished),
+        "failed": sum(1 for _, emoji in finished.values() if emoji == "💔"),
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_s": round(len(finished) / elapsed, 3) if elapsed > 0 else None,
+        "latency_p50_s": percentile(latencies, 0.50),
+        "latency_p95_s": percentile(latencies, 0.95),
+        "latency_p99_s": percentile(latencies, 0.99),
+        # ru_maxrss è in KB su Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_child_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "peak_download_dir_mb": round(peak_disk / 1024 / 1024, 1),
+        "media_cache_mb": round(directory_size(bot.MEDIA_CACHE_DIR) / 1024 / 1024, 1),
+        "api_calls": stats["calls"],
+        "api_429": sum(stats["errors_429"].values()),
+        "api_bytes_received_mb": round(stats["bytes_received"] / 1024 / 1024, 1),
+        "media_cache": bot.media_cache.stats(),
+        "file_id_cache": bot.file_id_cache.stats(),
+    }
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="yatytb-bench-")
+    api_proc, api_url = start_fake_api(args)
+    try:
+        # Configurazione del bot e degli stub prima dell'import di bot.py
+        os.environ["PATH"] = os.path.join(BENCH_DIR, "stubs") + os.pathsep + os.environ["PATH"]
+        os.environ.setdefault("BOT_TOKEN", "123456:bench")
+        os.environ["ALLOWED_IDS"] = ",".join(str(1000 + i) for i in range(args.chats))
+        os.environ["DOWNLOAD_DIR"] = os.path.join(workdir, "downloads")
+        os.environ["DATA_DIR"] = os.path.join(workdir, "data")
+        os.environ.update(
+            BENCH_FILE_SIZE=str(args.file_size),
+            BENCH_DURATION=str(args.duration),
+            BENCH_DOWNLOAD_RATE=str(args.download_rate),
+            BENCH_MEDIA_URL=api_url,
+        )
+        sys.path.insert(0, REPO_DIR)
+        results = asyncio.run(run(args, api_url, workdir))
+    finally:
+        api_proc.terminate()
+        api_proc.wait()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for key, value in results.items():
+        print(f"{key:>24}: {value}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0 if results["completed"] == results["messages"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,13 +10,14 @@
 #
 # Funzionalità principali:
 # - Scarica video e audio da YouTube, Instagram e altre piattaforme supportate da `yt-dlp`.
-# - Gestisce i post di Instagram (foto e video) utilizzando `gallery-dl`.
-# - Supporta il download di audio in formato MP3 se specificato nel messaggio.
+# - Gestisce i post di Instagram (foto e video) utilizzando `gallery-dl`, scaricandone i media in parallelo.
+# - Supporta il download di audio (M4A/MP3, senza ricodifica quando possibile) se specificato nel messaggio.
 # - Recupera dettagli del video (descrizione, durata, uploader, ecc.) per i video scaricati.
 # - Invia i file scaricati come messaggi multimediali su Telegram.
 # - Supporta l'invio di gruppi di media (es. più immagini in un unico messaggio).
+# - Gestisce messaggi con più link e playlist, scaricando gli elementi in parallelo e inviandoli nell'ordine del messaggio.
 # - Aggiunge reazioni ai messaggi con link validi ("👍") o segnala errori con reazioni ("💔").
-# - Elimina i file scaricati dal server dopo l'invio per risparmiare spazio.
+# - Scarica ogni richiesta in una cartella di lavoro isolata, eliminata dopo l'invio.
 #
 # Sicurezza:
 # - Controlla che solo gli utenti autorizzati (definiti tramite la variabile d'ambiente `ALLOWED_IDS`) possano interagire con il bot.
@@ -33,32 +34,88 @@
 # 2. Il bot verifica se l'utente è autorizzato e se il messaggio contiene un link valido.
 # 3. In base al tipo di contenuto (audio, video, immagini), il bot utilizza `yt-dlp` o `gallery-dl` per scaricare i file.
 # 4. I file scaricati vengono inviati all'utente come messaggi multimediali.
-# 5. Dopo l'invio, i file vengono eliminati dal server per mantenere pulita la directory di lavoro.
+# 5. Dopo l'invio, la cartella di lavoro viene eliminata; i file restano in una cache su disco con quota, per le richieste successive.
 
 import os
 import re
 import asyncio
 import tempfile
-from telegram import Update, InputMediaPhoto, InputMediaVideo, InputMediaAudio
+from telegram import Update, Message, Chat, InputMediaPhoto, InputMediaVideo, InputMediaAudio
 from telegram.ext import ApplicationBuilder, MessageHandler, ContextTypes, filters
 import logging
 import shutil
 import humanize
-import subprocess
 import json
+import mimetypes
 from telegram.constants import ParseMode
-from telegram.error import TelegramError, NetworkError, TimedOut
+from telegram.error import NetworkError, TimedOut, RetryAfter, BadRequest, Forbidden
 import time
 import signal
+import functools
+import itertools
+from collections import Counter
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import contextlib
+import sqlite3
+import threading
+import hashlib
+import uuid
+import contextvars
+import httpx
+import socket
+import secrets
+import ssl
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor
 
 # Variabili d'ambiente
 TOKEN = os.environ.get("BOT_TOKEN")
 ALLOWED_IDS = set(map(int, os.getenv("ALLOWED_IDS", "").split(",")))
 COOKIES_PATH = "/app/cookies/cookies.txt"
-DOWNLOAD_DIR = "/app/downloads"
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "/app/downloads")
 LOG_TO_FILE = os.getenv("LOG_TO_FILE", "false").lower() == "true"
 LOG_FILE_PATH = os.getenv("LOG_FILE_PATH", "bot.log")
-MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB limite massimo
+# Server Bot API locale (telegram-bot-api --local): file fino a 2GB inviati per percorso, senza upload
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")  # es. http://telegram-bot-api:8081/bot
+BOT_API_FILE_URL = os.getenv("BOT_API_FILE_URL")  # es. http://telegram-bot-api:8081/file/bot
+BOT_API_LOCAL_MODE = os.getenv("BOT_API_LOCAL_MODE", "false").lower() == "true"
+DEFAULT_MAX_FILE_SIZE = 2000 * 1024 * 1024 if BOT_API_LOCAL_MODE else 50 * 1024 * 1024  # 2GB in locale, 50MB con l'API pubblica
+MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", str(DEFAULT_MAX_FILE_SIZE)))
+FORMAT_SIZE_MARGIN = 0.95  # Margine sulle dimensioni stimate dei formati, spesso approssimative
+DATA_DIR = os.getenv("DATA_DIR", "/app/data")  # Dati persistenti (cache, code)
+FILE_ID_CACHE_PATH = os.getenv("FILE_ID_CACHE_PATH", os.path.join(DATA_DIR, "file_ids.sqlite3"))
+FILE_ID_CACHE_TTL = int(os.getenv("FILE_ID_CACHE_TTL", str(30 * 24 * 3600)))  # 30 giorni
+FILE_ID_CACHE_MAX_ENTRIES = int(os.getenv("FILE_ID_CACHE_MAX_ENTRIES", "10000"))
+# Cache su disco dei file scaricati, nello stesso filesystem dei download per usare hard link e rename atomici
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(DOWNLOAD_DIR, "cache"))
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(5 * 1024 * 1024 * 1024)))  # 5GB, 0 disattiva la cache
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", os.path.join(DATA_DIR, "jobs.sqlite3"))
+MAX_JOB_ATTEMPTS = int(os.getenv("MAX_JOB_ATTEMPTS", "3"))  # Riavvii dopo i quali un job interrotto viene abbandonato
+JOB_RETENTION = 7 * 24 * 3600  # I job conclusi vengono rimossi dalla coda dopo 7 giorni
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "25"))  # Attesa dei job in corso all'arresto
+# Ruolo del processo: "all" fa tutto, "ingress" riceve gli update e accoda i job, "worker" li esegue dalla coda condivisa
+BOT_ROLE = os.getenv("BOT_ROLE", "all").lower()
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"  # Proprietario dei lease nella coda
+JOB_LEASE_TIMEOUT = float(os.getenv("JOB_LEASE_TIMEOUT", "60"))  # Senza heartbeat entro questo tempo il job torna in coda
+JOB_HEARTBEAT_INTERVAL = JOB_LEASE_TIMEOUT / 3
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1" if BOT_ROLE == "worker" else "5"))  # I job accodati da altri processi non svegliano il dispatcher
+# Endpoint HTTP delle metriche in formato Prometheus (disattivato con porta 0)
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Modalità webhook: con WEBHOOK_URL impostato gli update arrivano via HTTP invece che con il long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # URL pubblico registrato su Telegram, es. https://bot.example.com/telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or (urlsplit(WEBHOOK_URL).path or "/" if WEBHOOK_URL else "/telegram")  # Percorso locale, diverso da quello pubblico se il proxy lo riscrive
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")  # Confrontato con l'header X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_TLS_CERT = os.getenv("WEBHOOK_TLS_CERT")  # Certificato e chiave per servire HTTPS direttamente; senza, il TLS resta al reverse proxy
+WEBHOOK_TLS_KEY = os.getenv("WEBHOOK_TLS_KEY")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Connessioni contemporanee aperte da Telegram
+MAX_REQUEST_BODY = 1024 * 1024  # Gli update di Telegram sono piccoli: corpi più grandi vengono rifiutati
 
 # Configurazione logging
 handlers = [logging.StreamHandler()]
@@ -78,31 +135,1407 @@ logging.basicConfig(
 for logger_name in ["telegram", "httpx", "asyncio"]:
     logging.getLogger(logger_name).setLevel(logging.WARNING)
 
-# Configurazione timeout e chunk size
-CHUNK_SIZE = 20 * 1024 * 1024  # Ridotto a 20MB per chunk
+# Configurazione timeout e suddivisione dei video grandi
+SPLIT_LARGE_VIDEOS = os.getenv("SPLIT_LARGE_VIDEOS", "true").lower() == "true"
+MAX_SPLIT_FILE_SIZE = int(os.getenv("MAX_SPLIT_FILE_SIZE", str(max(500 * 1024 * 1024, 2 * MAX_FILE_SIZE))))  # Video più grandi non vengono scaricati
+SPLIT_SIZE_MARGIN = 0.9  # Margine sulla dimensione delle parti: i tagli cadono sui keyframe, non al secondo esatto
+SPLIT_MAX_DEPTH = 2  # Nuove suddivisioni al massimo di una parte rimasta oltre il limite
+VIDEO_EXTENSIONS = ['.mp4', '.webm', '.mkv', '.mov']
+FASTSTART_EXTENSIONS = ['.mp4', '.mov']  # Contenitori in cui il moov atom può stare in fondo al file
+PREPARE_VIDEOS = os.getenv("PREPARE_VIDEOS", "true").lower() == "true"  # Faststart, dimensioni e miniatura prima dell'invio
+THUMBNAIL_SIZE = 320  # Lato massimo delle miniature accettato da Telegram
+AUDIO_EXTENSIONS = ['.mp3', '.m4a']  # Formati riprodotti da Telegram con sendAudio
+OTHER_AUDIO_EXTENSIONS = ['.opus', '.ogg', '.oga', '.flac', '.wav', '.aac']
+
+# Avanzamento del download
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "3"))  # Secondi minimi tra due modifiche del messaggio di stato
+PROGRESS_PREFIX = "PROGRESS "
+PROGRESS_TEMPLATE = PROGRESS_PREFIX + "%(progress.downloaded_bytes)s %(progress.total_bytes)s %(progress.total_bytes_estimate)s %(progress.speed)s"
+FILE_PREFIX = "FILE\t"
 MAX_RETRIES = 5  # Aumentato il numero di tentativi
 RETRY_DELAY = 10  # Aumentato il delay tra i tentativi
+MAX_RETRY_DELAY = 60  # Limite del backoff esponenziale tra i tentativi
 UPLOAD_TIMEOUT = 300  # Timeout di 5 minuti per l'upload
+# Upload in streaming: il corpo multipart viene letto a blocchi (dal file o dall'output di yt-dlp) invece che caricato in memoria
+STREAM_UPLOADS = os.getenv("STREAM_UPLOADS", "false").lower() == "true"
+STREAM_BUFFER_SIZE = int(os.getenv("STREAM_BUFFER_SIZE", str(4 * 1024 * 1024)))  # Memoria massima bufferizzata per ogni upload
+STREAM_CHUNK_SIZE = min(256 * 1024, max(1, STREAM_BUFFER_SIZE // 4))
+
+# Limiti di invio verso Telegram (richieste al secondo)
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "25"))  # Limite complessivo del bot (Telegram ne tollera circa 30)
+CHAT_SEND_RATE = float(os.getenv("CHAT_SEND_RATE", "1"))  # Limite per singola chat
+CHAT_SEND_BURST = int(os.getenv("CHAT_SEND_BURST", "3"))  # Invii consecutivi ammessi in una chat prima di rallentare
+MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", "4"))  # Upload di file contemporanei in totale
+# Priorità degli invii: a parità di token disponibili passano prima reazioni e messaggi brevi, poi gli upload
+PRIORITY_REACTION = 0
+PRIORITY_TEXT = 1
+PRIORITY_UPLOAD = 2
+
+# Configurazione concorrenza
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "4"))  # Download contemporanei in totale
+MAX_JOBS_PER_USER = int(os.getenv("MAX_JOBS_PER_USER", "2"))  # Download contemporanei per utente
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "4"))  # Thread per le operazioni bloccanti (I/O su disco)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))  # Update Telegram gestiti in parallelo
+
+# Messaggi con più link e playlist
+MAX_LINKS_PER_MESSAGE = int(os.getenv("MAX_LINKS_PER_MESSAGE", "20"))  # Link considerati in un singolo messaggio
+PLAYLIST_MAX_ITEMS = int(os.getenv("PLAYLIST_MAX_ITEMS", "20"))  # Voci scaricate al massimo da una playlist o un canale
+MAX_PARALLEL_ITEMS = int(os.getenv("MAX_PARALLEL_ITEMS", "3"))  # Elementi di una richiesta scaricati in parallelo
+
+# Post di Instagram (album): URL dei media letti con gallery-dl -g e scaricati in parallelo
+ALBUM_PARALLEL_DOWNLOADS = int(os.getenv("ALBUM_PARALLEL_DOWNLOADS", "4"))  # Media di un album scaricati in parallelo (0 = download con gallery-dl)
+ALBUM_DOWNLOAD_TIMEOUT = 60  # Timeout di rete per ogni media dell'album
+RESIZE_PHOTOS = os.getenv("RESIZE_PHOTOS", "true").lower() == "true"  # Ricomprime con Pillow, se installato, le foto oltre i limiti di Telegram
+PHOTO_MAX_SIZE = 10 * 1024 * 1024  # Dimensione massima di una foto inviata come foto
+PHOTO_MAX_DIMENSIONS = 10000  # Somma massima di larghezza e altezza di una foto
+PHOTO_MAX_SIDE = 2560  # Lato massimo delle foto ricompresse: Telegram non ne mostra di più grandi
+PHOTO_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+
+# Motore di download: "cli" avvia yt-dlp/gallery-dl a ogni richiesta, "inprocess" usa processi già pronti
+DOWNLOAD_ENGINE = os.getenv("DOWNLOAD_ENGINE", "cli").lower()
+ENGINE_WORKERS = int(os.getenv("ENGINE_WORKERS", str(MAX_CONCURRENT_JOBS)))
+
+async def run_command(cmd):
+    """Esegue un comando esterno senza bloccare l'event loop e ne restituisce (returncode, stdout, stderr)."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    return proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+class JobScheduler:
+    """Limita i download contemporanei (globali e per utente) ed esegue le operazioni bloccanti in un pool di thread."""
+
+    def __init__(self, max_jobs, max_jobs_per_user, workers):
+        self.max_jobs_per_user = max_jobs_per_user
+        self.global_slots = asyncio.Semaphore(max_jobs)
+        self.user_slots = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="yatytb")
+
+    async def run(self, user_id, coro_fn, *args):
+        """Attende uno slot libero per l'utente e uno globale, poi esegue il job."""
+        user_slots = self.user_slots.setdefault(user_id, asyncio.Semaphore(self.max_jobs_per_user))
+        async with user_slots:
+            async with self.global_slots:
+                return await coro_fn(*args)
+
+    async def run_blocking(self, fn, *args, **kwargs):
+        """Esegue una funzione bloccante nel pool di thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+scheduler = JobScheduler(MAX_CONCURRENT_JOBS, MAX_JOBS_PER_USER, WORKER_THREADS)
+
+# Tempi per fase del job in corso; i task creati dal job (elementi, pipeline di upload) ereditano lo stesso dizionario
+job_spans = contextvars.ContextVar("job_spans", default=None)
+
+class Metrics:
+    """Contatori e istogrammi in memoria, esposti in formato testuale Prometheus."""
+
+    STAGE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self):
+        self.descriptions = {}  # nome -> (tipo, descrizione)
+        self.counters = Counter()  # (nome, etichette) -> valore
+        self.histograms = {}  # (nome, etichette) -> [conteggi per bucket, somma, numero]
+        self.callbacks = {}  # nome -> funzione che restituisce {etichette: valore}, letta a ogni richiesta
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def describe(self, name, metric_type, description, callback=None):
+        self.descriptions[name] = (metric_type, description)
+        if callback:
+            self.callbacks[name] = callback
+
+    def inc(self, name, value=1, **labels):
+        self.counters[(name, self._labels(labels))] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, self._labels(labels))
+        histogram = self.histograms.setdefault(key, [[0] * len(self.STAGE_BUCKETS), 0.0, 0])
+        for i, bound in enumerate(self.STAGE_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def stage(self, stage, seconds):
+        """Registra la durata di una fase, sia nell'istogramma globale sia nei tempi del job in corso."""
+        self.observe("yatytb_stage_seconds", seconds, stage=stage)
+        spans = job_spans.get()
+        if spans is not None:
+            spans[stage] += seconds
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """Misura la durata del blocco come fase `stage`."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stage(stage, time.monotonic() - start)
+
+    @staticmethod
+    def _format(name, labels, value):
+        if labels:
+            name += "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+        return f"{name} {value:g}" if isinstance(value, float) else f"{name} {value}"
+
+    def render(self):
+        """Testo dell'endpoint /metrics."""
+        samples = {}  # nome -> righe
+        for (name, labels), value in self.counters.items():
+            samples.setdefault(name, []).append(self._format(name, labels, value))
+        for (name, labels), (buckets, total, count) in self.histograms.items():
+            lines = samples.setdefault(name, [])
+            for bound, bucket in zip(self.STAGE_BUCKETS, buckets):
+                lines.append(self._format(f"{name}_bucket", labels + (("le", f"{bound:g}"),), bucket))
+            lines.append(self._format(f"{name}_bucket", labels + (("le", "+Inf"),), count))
+            lines.append(self._format(f"{name}_sum", labels, total))
+            lines.append(self._format(f"{name}_count", labels, count))
+        for name, callback in self.callbacks.items():
+            try:
+                values = callback()
+            except Exception as e:
+                logging.error(f"Errore durante la lettura della metrica {name}: {e}")
+                continue
+            samples[name] = [self._format(name, self._labels(labels), value) for labels, value in values]
+        output = []
+        for name in sorted(samples):
+            metric_type, description = self.descriptions.get(name, ("untyped", ""))
+            output += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"] + samples[name]
+        return "\n".join(output) + "\n"
+
+metrics = Metrics()
+metrics.describe("yatytb_stage_seconds", "histogram", "Durata delle fasi dei job (queue_wait, probe, download, postprocess, upload, total)")
+metrics.describe("yatytb_downloaded_bytes_total", "counter", "Byte scaricati dalle piattaforme")
+metrics.describe("yatytb_uploaded_bytes_total", "counter", "Byte caricati su Telegram")
+metrics.describe("yatytb_send_retries_total", "counter", "Nuovi tentativi di invio a Telegram, per motivo")
+metrics.describe("yatytb_items_total", "counter", "Elementi elaborati, per extractor ed esito")
+metrics.describe("yatytb_jobs_total", "counter", "Job conclusi, per esito")
+
+async def serve_metrics(method, headers, body):
+    return 200, "text/plain; version=0.0.4; charset=utf-8", metrics.render().encode()
+
+class HealthState:
+    """Stato del servizio condiviso dalle sonde /healthz e /readyz e dall'arresto tramite segnale."""
+
+    def __init__(self):
+        self.ready = False  # Bot avviato e dispatcher in esecuzione
+        self.stopping = False  # Arresto iniziato: il bilanciatore deve smettere di inviare richieste
+
+    def is_alive(self):
+        # Il processo è vivo finché il dispatcher dei job non si ferma per un errore
+        task = dispatcher.task
+        return self.stopping or task is None or not task.done()
+
+    def is_ready(self):
+        return self.ready and not self.stopping and dispatcher.accepting and self.is_alive()
+
+health = HealthState()
+
+class StatusServer:
+    """Server HTTP minimo su asyncio per gli endpoint di servizio (metriche, sonde di salute, webhook)."""
+
+    def __init__(self, host, port, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        # percorso -> handler(metodo, header, body) -> (stato, tipo, corpo)
+        self.routes = {"/healthz": self._healthz, "/readyz": self._readyz}
+        self.server = None
+        self.connections = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port, ssl=self.ssl_context)
+        logging.info(f"Endpoint HTTP{'S' if self.ssl_context else ''} in ascolto su {self.host}:{self.port}: {', '.join(sorted(self.routes))}")
+
+    async def _healthz(self, method, headers, body):
+        if health.is_alive():
+            return 200, "text/plain", b"ok\n"
+        return 503, "text/plain", b"dispatcher stopped\n"
+
+    async def _readyz(self, method, headers, body):
+        if health.is_ready():
+            return 200, "text/plain", b"ready\n"
+        return 503, "text/plain", b"stopping\n" if health.stopping else b"starting\n"
+
+    async def _handle(self, reader, writer):
+        # Connessioni keep-alive: Telegram e i reverse proxy riusano la stessa connessione per più richieste
+        self.connections.add(writer)
+        try:
+            while True:
+                request_line = (await asyncio.wait_for(reader.readline(), 60)).decode("latin-1").split()
+                if len(request_line) < 2:
+                    return
+                headers = {}
+                while True:
+                    line = (await asyncio.wait_for(reader.readline(), 10)).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                if length > MAX_REQUEST_BODY:
+                    await self._respond(writer, 413, "text/plain", b"payload too large\n", False)
+                    return
+                body = await asyncio.wait_for(reader.readexactly(length), 30) if length > 0 else b""
+                method, path = request_line[0], urlsplit(request_line[1]).path
+                handler = self.routes.get(path)
+                if handler is None:
+                    status, content_type, payload = 404, "text/plain", b"not found\n"
+                else:
+                    status, content_type, payload = await handler(method, headers, body)
+                keep_alive = (
+                    request_line[-1] == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                    and not health.stopping
+                )
+                await self._respond(writer, status, content_type, payload, keep_alive)
+                if not keep_alive:
+                    return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError, ssl.SSLError):
+            pass
+        except Exception as e:
+            logging.error(f"Errore durante la gestione di una richiesta HTTP: {e}")
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, content_type, payload, keep_alive):
+        reason = {
+            200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 503: "Service Unavailable",
+        }.get(status, "")
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + payload
+        )
+        await writer.drain()
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            # Chiude anche le connessioni keep-alive inattive, che altrimenti bloccherebbero wait_closed
+            for writer in list(self.connections):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+status_server = StatusServer(METRICS_HOST, METRICS_PORT)
+status_server.routes["/metrics"] = serve_metrics
+
+# Parametri di tracciamento che non cambiano il contenuto del link
+TRACKING_PARAMS = {"igsh", "igshid", "si", "fbclid", "gclid", "feature", "utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content"}
+
+def canonicalize_url(url):
+    """Normalizza un URL rimuovendo frammento e parametri di tracciamento, per usarlo come chiave di cache."""
+    parts = urlsplit(url.strip())
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k.lower() not in TRACKING_PARAMS]
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return urlunsplit(("https", host, parts.path.rstrip("/"), urlencode(sorted(query)), ""))
+
+# Link dei siti più comuni riconducibili a extractor + id del contenuto senza estrarre i metadati
+CANONICAL_PATTERNS = [
+    ("youtube", re.compile(r"^(?:m\.|music\.)?youtube\.com/(?:shorts|embed|live|v)/([\w-]{11})")),
+    ("youtube", re.compile(r"^youtu\.be/([\w-]{11})")),
+    ("instagram", re.compile(r"^instagram\.com/(?:[\w.]+/)?(?:p|reels?|tv)/([\w-]+)")),
+    ("tiktok", re.compile(r"^(?:m\.)?tiktok\.com/@[\w.-]+/(?:video|photo)/(\d+)")),
+    ("twitter", re.compile(r"^(?:mobile\.)?(?:twitter|x)\.com/\w+/status(?:es)?/(\d+)")),
+]
+
+def canonical_key(url):
+    """Chiave canonica di un link: "extractor:id" per i siti noti (youtu.be, watch?v=, /shorts/, reel...), altrimenti l'URL normalizzato.
+
+    Link diversi allo stesso contenuto, anche con parametri di tracciamento, hanno la stessa chiave.
+    """
+    canonical = canonicalize_url(url)
+    parts = urlsplit(canonical)
+    location = parts.netloc + parts.path
+    query = dict(parse_qsl(parts.query))
+    if "list" in query:
+        # watch?v=...&list=... e youtu.be/...?list=... sono playlist per yt-dlp: il link resta distinto dal singolo video
+        return canonical
+    if re.match(r"^(?:m\.|music\.)?youtube\.com/watch$", location):
+        video_id = query.get("v", "")
+        if re.fullmatch(r"[\w-]{11}", video_id):
+            return f"youtube:{video_id}"
+    for extractor, pattern in CANONICAL_PATTERNS:
+        match = pattern.match(location)
+        if match:
+            return f"{extractor}:{match.group(1)}"
+    return canonical
+
+class FileIdCache:
+    """Cache persistente (SQLite) dei file_id restituiti da Telegram, per reinviare i link già scaricati senza download."""
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)  # Condivisa tra ingress e worker
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_ids ("
+                "key TEXT PRIMARY KEY, payload TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.conn.commit()
+        return self.conn
+
+    def get(self, key, record=True):
+        """Restituisce gli elementi salvati per la chiave (o None) e, con record, aggiorna i contatori hit/miss.
+
+        Le letture ripetute della stessa chiave per lo stesso elemento usano record=False, per contarlo una volta sola.
+        """
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            row = conn.execute("SELECT payload, created_at FROM file_ids WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= self.ttl:
+                conn.execute("UPDATE file_ids SET last_used = ? WHERE key = ?", (now, key))
+                conn.commit()
+                self.hits += record
+                return json.loads(row[0])
+            if row:
+                conn.execute("DELETE FROM file_ids WHERE key = ?", (key,))
+                conn.commit()
+            self.misses += record
+            return None
+
+    def put(self, key, items):
+        """Salva gli elementi inviati e applica l'evizione per scadenza e numero massimo di voci."""
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO file_ids (key, payload, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(items), now, now)
+            )
+            conn.execute("DELETE FROM file_ids WHERE created_at < ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM file_ids WHERE key IN ("
+                "SELECT key FROM file_ids ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            conn.commit()
+
+    def delete(self, key):
+        with self.lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM file_ids WHERE key = ?", (key,))
+            conn.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+file_id_cache = FileIdCache(FILE_ID_CACHE_PATH, FILE_ID_CACHE_TTL, FILE_ID_CACHE_MAX_ENTRIES)
+metrics.describe("yatytb_file_id_cache_hits_total", "counter", "Richieste servite dalla cache dei file_id",
+                 lambda: [({}, file_id_cache.hits)])
+metrics.describe("yatytb_file_id_cache_misses_total", "counter", "Richieste non presenti nella cache dei file_id",
+                 lambda: [({}, file_id_cache.misses)])
+
+class MediaCache:
+    """Cache su disco dei file scaricati, indirizzata per contenuto (extractor + id + formato), con quota in byte ed evizione LRU.
+
+    Ogni voce è una cartella con i file e un manifest.json. Viene scritta in una cartella temporanea e pubblicata
+    con un rename atomico, così job concorrenti (anche in processi diversi) non vedono mai voci incomplete.
+    I file vengono collegati alle cartelle dei job con hard link: l'evizione di una voce non tocca i job che la stanno usando.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, hashlib.sha256(key.encode()).hexdigest())
+
+    @staticmethod
+    def _link(source, destination):
+        """Hard link (nessuna copia) se possibile, altrimenti copia."""
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copy2(source, destination)
+
+    def get(self, key, workspace):
+        """Collega nella cartella del job i file della voce, restituendo [(id della voce, percorso)], o None se assente."""
+        if not self.enabled:
+            return None
+        entry_dir = self._entry_dir(key)
+        manifest_path = os.path.join(entry_dir, "manifest.json")
+        linked = []
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            for item in manifest["files"]:
+                destination = os.path.join(workspace, item["name"])
+                if not os.path.exists(destination):
+                    self._link(os.path.join(entry_dir, item["name"]), destination)
+                linked.append((item["entry_id"], destination))
+            os.utime(manifest_path)  # Ultimo utilizzo, per l'evizione LRU
+        except (OSError, ValueError, KeyError):
+            # Voce assente, eliminata nel frattempo dall'evizione o con un manifest non valido
+            for _, path in linked:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return linked
+
+    def put(self, key, files):
+        """Salva i file [(id della voce, percorso)] di un download concluso e applica la quota."""
+        if not self.enabled or not files:
+            return
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+        if sum(os.path.getsize(path) for _, path in files) > self.max_bytes:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        temp_dir = os.path.join(self.root, f".tmp-{uuid.uuid4().hex}")
+        try:
+            os.makedirs(temp_dir)
+            manifest = {"key": key, "created_at": time.time(), "files": []}
+            for entry_id, path in files:
+                name = os.path.basename(path)
+                self._link(path, os.path.join(temp_dir, name))
+                manifest["files"].append({"name": name, "entry_id": entry_id})
+            with open(os.path.join(temp_dir, "manifest.json"), "w") as f:
+                json.dump(manifest, f)
+            # Pubblicazione atomica: se un altro job ha salvato la stessa voce, vince il primo
+            os.rename(temp_dir, entry_dir)
+            logging.info(f"File salvati nella cache su disco: {key}")
+        except OSError as e:
+            if not os.path.exists(entry_dir):
+                logging.error(f"Errore durante il salvataggio nella cache su disco di {key}: {e}")
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Elimina le voci usate meno di recente finché la cache non rientra nella quota, e le cartelle temporanee orfane."""
+        if not os.path.isdir(self.root):
+            return
+        with self.lock:
+            entries = []
+            total = 0
+            now = time.time()
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                try:
+                    if name.startswith(".tmp-"):
+                        # Scritture interrotte da un crash
+                        if now - os.path.getmtime(path) > 3600:
+                            shutil.rmtree(path, ignore_errors=True)
+                        continue
+                    size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+                    last_used = os.path.getmtime(os.path.join(path, "manifest.json"))
+                except OSError:
+                    continue
+                entries.append((last_used, size, path))
+                total += size
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                # Rinominata prima dell'eliminazione: i lettori non vedono mai una voce a metà
+                trash = os.path.join(self.root, f".tmp-{uuid.uuid4().hex}")
+                try:
+                    os.rename(path, trash)
+                except OSError:
+                    continue
+                shutil.rmtree(trash, ignore_errors=True)
+                total -= size
+                logging.info(f"Voce eliminata dalla cache su disco: {os.path.basename(path)} ({humanize.naturalsize(size)})")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES)
+metrics.describe("yatytb_media_cache_hits_total", "counter", "Elementi serviti dalla cache su disco",
+                 lambda: [({}, media_cache.hits)])
+metrics.describe("yatytb_media_cache_misses_total", "counter", "Elementi non presenti nella cache su disco",
+                 lambda: [({}, media_cache.misses)])
+
+class InflightDownloads:
+    """Download in corso per chiave canonica, per unire le richieste concorrenti dello stesso contenuto.
+
+    Il primo elemento con una certa chiave scarica il contenuto; gli altri ne attendono l'esito e riusano i suoi file
+    (collegati con hard link) o i file_id, con un solo accesso all'origine. Vale all'interno del processo:
+    tra processi diversi restano la cache su disco e quella dei file_id.
+    """
+
+    def __init__(self):
+        self.leaders = {}  # chiave -> (elemento che scarica, future con l'esito)
+        self.coalesced = 0
+
+    def join(self, ctx):
+        """Registra ctx come responsabile del download della sua chiave e restituisce None,
+        oppure restituisce il future dell'elemento già in corso con la stessa chiave."""
+        key = ctx.cache_key()
+        entry = self.leaders.get(key)
+        if entry is None:
+            self.leaders[key] = (ctx, asyncio.get_running_loop().create_future())
+            return None
+        self.coalesced += 1
+        return entry[1]
+
+    def resolve(self, ctx, result):
+        """Passa l'esito del download di ctx agli elementi in attesa: ("files", info, [(id della voce, percorso)]),
+        ("cached", elementi inviati) o None se non è riuscito. Non fa nulla se ctx non è responsabile della chiave."""
+        key = ctx.cache_key()
+        entry = self.leaders.get(key)
+        if entry is None or entry[0] is not ctx:
+            return
+        del self.leaders[key]
+        entry[1].set_result(result)
+
+    @staticmethod
+    def link(files, workspace):
+        """Collega nella cartella di lavoro i file [(id della voce, percorso)] scaricati da un altro elemento.
+
+        Restituisce [(id della voce, nuovo percorso)], o None se nel frattempo l'altro elemento li ha già eliminati.
+        """
+        linked = []
+        try:
+            for entry_id, path in files:
+                destination = os.path.join(workspace, os.path.basename(path))
+                if not os.path.exists(destination):
+                    MediaCache._link(path, destination)
+                linked.append((entry_id, destination))
+        except OSError:
+            for _, path in linked:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+            return None
+        return linked
+
+inflight = InflightDownloads()
+metrics.describe("yatytb_coalesced_items_total", "counter", "Elementi uniti a un download già in corso per lo stesso contenuto",
+                 lambda: [({}, inflight.coalesced)])
+
+# Stati dei job nella coda persistente
+JOB_QUEUED = "queued"
+JOB_DOWNLOADING = "downloading"
+JOB_UPLOADING = "uploading"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+class JobQueue:
+    """Coda persistente (SQLite in modalità WAL) dei link accettati e del loro stato, per riprenderli dopo un riavvio."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)  # Condivisa tra ingress e worker
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+                "priority INTEGER NOT NULL DEFAULT 0, state TEXT NOT NULL, payload TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, chat_id, id)")
+            # Lease dei worker, aggiunti alle code create prima della suddivisione in processi
+            columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+            if "lease_owner" not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN lease_owner TEXT")
+            if "lease_expires" not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN lease_expires REAL")
+            self.conn.commit()
+        return self.conn
+
+    @staticmethod
+    def _job(row):
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def enqueue(self, chat_id, user_id, payload, priority=0):
+        """Registra un nuovo job in stato queued e ne restituisce l'id."""
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            cursor = conn.execute(
+                "INSERT INTO jobs (chat_id, user_id, priority, state, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (chat_id, user_id, priority, JOB_QUEUED, json.dumps(payload), now, now)
+            )
+            conn.commit()
+            return cursor.lastrowid
+
+    def set_state(self, job_id, state):
+        with self.lock:
+            conn = self._connect()
+            if state in (JOB_DONE, JOB_FAILED):
+                # Un job concluso non appartiene più a nessun worker
+                conn.execute(
+                    "UPDATE jobs SET state = ?, updated_at = ?, lease_owner = NULL, lease_expires = NULL WHERE id = ?",
+                    (state, time.time(), job_id)
+                )
+            else:
+                conn.execute("UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?", (state, time.time(), job_id))
+            conn.commit()
+
+    def queued(self):
+        """Job in attesa non assegnati a un worker, nell'ordine di arrivo, job in esecuzione per utente in tutti i worker
+        e chat con un job già assegnato o in esecuzione."""
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE state = ? AND (lease_owner IS NULL OR lease_expires < ?) ORDER BY id", (JOB_QUEUED, now)
+            ).fetchall()
+            running = conn.execute(
+                "SELECT user_id, COUNT(*) AS count FROM jobs WHERE state IN (?, ?, ?) AND lease_expires >= ? GROUP BY user_id",
+                (JOB_QUEUED, JOB_DOWNLOADING, JOB_UPLOADING, now)
+            ).fetchall()
+            # Anche i job interrotti e non ancora rimessi in coda occupano la chat: verranno ripresi per primi
+            busy = conn.execute(
+                "SELECT DISTINCT chat_id FROM jobs WHERE state IN (?, ?) OR (state = ? AND lease_expires >= ?)",
+                (JOB_DOWNLOADING, JOB_UPLOADING, JOB_QUEUED, now)
+            ).fetchall()
+        return (
+            [self._job(row) for row in rows],
+            Counter({row["user_id"]: row["count"] for row in running}),
+            {row["chat_id"] for row in busy},
+        )
+
+    def claim(self, job_id, owner, lease):
+        """Assegna un job in attesa al worker owner per lease secondi; False se un altro worker l'ha preso prima."""
+        now = time.time()
+        with self.lock:
+            conn = self._connect()
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_owner = ?, lease_expires = ?, updated_at = ? "
+                "WHERE id = ? AND state = ? AND (lease_owner IS NULL OR lease_expires < ?)",
+                (owner, now + lease, now, job_id, JOB_QUEUED, now)
+            )
+            conn.commit()
+            return cursor.rowcount == 1
+
+    def heartbeat(self, owner, job_ids, lease):
+        """Rinnova i lease dei job in corso di owner; restituisce gli id dei job che gli appartengono ancora."""
+        if not job_ids:
+            return set()
+        placeholders = ",".join("?" * len(job_ids))
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                f"UPDATE jobs SET lease_expires = ? WHERE lease_owner = ? AND id IN ({placeholders})",
+                (time.time() + lease, owner, *job_ids)
+            )
+            rows = conn.execute(
+                f"SELECT id FROM jobs WHERE lease_owner = ? AND id IN ({placeholders})", (owner, *job_ids)
+            ).fetchall()
+            conn.commit()
+        return {row["id"] for row in rows}
+
+    def mark_sent(self, job_id, item):
+        """Registra nel payload un elemento del job già consegnato, per non inviarlo di nuovo se il job viene ripreso."""
+        with self.lock:
+            conn = self._connect()
+            row = conn.execute("SELECT payload FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            payload = json.loads(row["payload"])
+            payload["sent"] = sorted(set(payload.get("sent", [])) | {item})
+            conn.execute("UPDATE jobs SET payload = ? WHERE id = ?", (json.dumps(payload), job_id))
+            conn.commit()
+
+    def release(self, owner):
+        """Fa scadere subito i lease di owner, perché un altro worker riprenda i job interrotti senza attendere."""
+        with self.lock:
+            conn = self._connect()
+            conn.execute("UPDATE jobs SET lease_expires = 0 WHERE lease_owner = ?", (owner,))
+            conn.commit()
+
+    def chat_busy(self, chat_id):
+        """True se la chat ha job in attesa o in esecuzione, in qualsiasi worker."""
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT 1 FROM jobs WHERE chat_id = ? AND state IN (?, ?, ?) LIMIT 1",
+                (chat_id, JOB_QUEUED, JOB_DOWNLOADING, JOB_UPLOADING)
+            ).fetchone()
+        return row is not None
+
+    def unfinished_ids(self):
+        with self.lock:
+            rows = self._connect().execute(
+                "SELECT id FROM jobs WHERE state IN (?, ?, ?)", (JOB_QUEUED, JOB_DOWNLOADING, JOB_UPLOADING)
+            ).fetchall()
+        return {row["id"] for row in rows}
+
+    def recover(self, max_attempts, expired_only=False, owner=None):
+        """Rimette in coda i job interrotti da un arresto o da un crash; restituisce quelli abbandonati dopo troppi tentativi.
 
-def get_video_details(url, cookies_path):
-    """Recupera dettagli video (descrizione, durata, uploader, uploader_url, extractor, e like_count) da yt-dlp."""
+        Con un solo processo vengono ripresi tutti i job in esecuzione; con expired_only solo quelli con il lease
+        scaduto, cioè di worker terminati o bloccati, più quelli di owner (lo stesso worker riavviato)."""
+        now = time.time()
+        if expired_only:
+            orphaned, params = "(lease_expires IS NULL OR lease_expires < ? OR lease_owner = ?)", (now, owner)
+        else:
+            orphaned, params = "1", ()
+        with self.lock:
+            conn = self._connect()
+            # Transazione esclusiva: con più worker ogni job abbandonato viene segnalato una volta sola
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE jobs SET state = ?, attempts = attempts + 1, updated_at = ?, lease_owner = NULL, lease_expires = NULL "
+                f"WHERE state IN (?, ?) AND {orphaned}",
+                (JOB_QUEUED, now, JOB_DOWNLOADING, JOB_UPLOADING, *params)
+            )
+            # Job assegnati ma non ancora avviati: tornano disponibili senza contare un tentativo
+            conn.execute(
+                f"UPDATE jobs SET lease_owner = NULL, lease_expires = NULL WHERE state = ? AND lease_owner IS NOT NULL AND {orphaned}",
+                (JOB_QUEUED, *params)
+            )
+            abandoned = conn.execute(
+                "SELECT * FROM jobs WHERE state = ? AND attempts >= ?", (JOB_QUEUED, max_attempts)
+            ).fetchall()
+            conn.execute("UPDATE jobs SET state = ?, updated_at = ? WHERE state = ? AND attempts >= ?", (JOB_FAILED, now, JOB_QUEUED, max_attempts))
+            conn.execute("DELETE FROM jobs WHERE state IN (?, ?) AND updated_at < ?", (JOB_DONE, JOB_FAILED, now - JOB_RETENTION))
+            conn.commit()
+        return [self._job(row) for row in abandoned]
+
+job_queue = JobQueue(JOB_QUEUE_PATH)
+
+class JobDispatcher:
+    """Preleva i job dalla coda persistente rispettando priorità, ordine FIFO per chat e limiti di concorrenza."""
+
+    def __init__(self, queue, max_jobs, max_jobs_per_user, owner):
+        self.queue = queue
+        self.max_jobs = max_jobs
+        self.max_jobs_per_user = max_jobs_per_user
+        self.owner = owner  # Identificativo del worker nei lease della coda
+        self.bot = None
+        self.active = {}  # id del job -> (task, user_id)
+        self.wakeup = asyncio.Event()
+        self.accepting = True
+        self.task = None
+        self.heartbeat_task = None
+
+    def start(self, bot):
+        self.bot = bot
+        self.task = asyncio.create_task(self._run())
+        self.heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    def notify(self):
+        """Segnala che ci sono nuovi job o slot liberi."""
+        self.wakeup.set()
+
+    async def _run(self):
+        while self.accepting:
+            self.wakeup.clear()
+            try:
+                await self._dispatch()
+            except Exception as e:
+                logging.error(f"Errore durante la distribuzione dei job: {e}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _heartbeat(self):
+        """Rinnova i lease dei job in corso e rimette in coda quelli dei worker che hanno smesso di rispondere."""
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                job_ids = list(self.active)
+                owned = await scheduler.run_blocking(self.queue.heartbeat, self.owner, job_ids, JOB_LEASE_TIMEOUT)
+                for job_id in job_ids:
+                    if job_id not in owned and job_id in self.active:
+                        # Lease scaduto e ripreso da un altro worker: proseguire significherebbe inviare due volte
+                        logging.error(f"Lease del job {job_id} perso, esecuzione interrotta")
+                        self.active[job_id][0].cancel()
+                abandoned = await scheduler.run_blocking(self.queue.recover, MAX_JOB_ATTEMPTS, True)
+                await report_abandoned(self.bot, abandoned)
+                self.notify()
+            except Exception as e:
+                logging.error(f"Errore durante l'heartbeat dei job: {e}")
+
+    async def _dispatch(self):
+        jobs, per_user, busy_chats = await scheduler.run_blocking(self.queue.queued)
+        # Per ogni chat è candidato solo il job in attesa più vecchio (FIFO per chat), e solo quando nessun altro job
+        # della chat è in esecuzione: le risposte arrivano nell'ordine dei messaggi
+        heads = {}
+        for job in jobs:
+            if job["id"] not in self.active and job["chat_id"] not in busy_chats:
+                heads.setdefault(job["chat_id"], job)
+        # per_user conta i job in esecuzione dell'utente in tutti i worker, compresi quelli di questo processo
+        # Tra le chat, passano prima i job con priorità più alta, poi i più vecchi
+        for job in sorted(heads.values(), key=lambda job: (-job["priority"], job["id"])):
+            if not self.accepting or len(self.active) >= self.max_jobs:
+                break
+            if per_user[job["user_id"]] >= self.max_jobs_per_user:
+                continue
+            if not await scheduler.run_blocking(self.queue.claim, job["id"], self.owner, JOB_LEASE_TIMEOUT):
+                continue  # Preso da un altro worker nel frattempo
+            per_user[job["user_id"]] += 1
+            self.active[job["id"]] = (asyncio.create_task(self._run_job(job)), job["user_id"])
+
+    async def _run_job(self, job):
+        try:
+            payload = job["payload"]
+            message = Message.de_json(payload["message"], self.bot)
+            contexts = [RequestContext(url, payload["is_audio"], job_id=job["id"]) for url in payload_urls(payload)]
+            contexts[0].cache_checked = payload.get("cache_checked", False)
+            # Gli elementi consegnati prima di un'interruzione non vengono inviati di nuovo
+            delivered = set(payload.get("sent", []))
+            success = await scheduler.run(job["user_id"], process_request, message, self.bot, contexts, delivered)
+            await scheduler.run_blocking(self.queue.set_state, job["id"], JOB_DONE if success else JOB_FAILED)
+        except asyncio.CancelledError:
+            # Arresto in corso: il job resta nel suo stato e verrà ripreso al riavvio o da un altro worker
+            logging.info(f"Job {job['id']} interrotto, verrà ripreso")
+            raise
+        except Exception as e:
+            logging.error(f"Errore durante l'esecuzione del job {job['id']}: {e}")
+            await scheduler.run_blocking(self.queue.set_state, job["id"], JOB_FAILED)
+        finally:
+            self.active.pop(job["id"], None)
+            self.notify()
+
+    async def drain(self, timeout):
+        """Smette di avviare job e attende quelli in corso fino a timeout secondi; gli altri vengono interrotti."""
+        self.accepting = False
+        self.notify()
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        tasks = [task for task, _ in self.active.values()]
+        if tasks:
+            logging.info(f"Attesa di {len(tasks)} job in corso (massimo {timeout:.0f} secondi)")
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+            await asyncio.gather(self.heartbeat_task, return_exceptions=True)
+            # I job interrotti passano subito agli altri worker, senza attendere la scadenza del lease
+            await scheduler.run_blocking(self.queue.release, self.owner)
+
+async def report_abandoned(bot, jobs):
+    """Segnala con 💔 i job abbandonati dopo troppi tentativi."""
+    for job in jobs:
+        logging.error(f"Job {job['id']} abbandonato dopo {job['attempts']} tentativi: {' '.join(payload_urls(job['payload']))}")
+        await react(bot, job["chat_id"], job["payload"]["message"]["message_id"], "💔")
+
+dispatcher = JobDispatcher(job_queue, MAX_CONCURRENT_JOBS, MAX_JOBS_PER_USER, WORKER_ID)
+metrics.describe("yatytb_jobs_active", "gauge", "Job in esecuzione", lambda: [({}, len(dispatcher.active))])
+
+class EngineUnavailable(Exception):
+    """Il motore in-process non può gestire la richiesta: si ripiega sui comandi yt-dlp/gallery-dl."""
+
+def _engine_init():
+    """Inizializza un processo del pool importando in anticipo yt-dlp, i suoi extractor e gallery-dl."""
+    import yt_dlp
+    import gallery_dl.job  # noqa: F401
+    from yt_dlp.extractor import import_extractors
+    import_extractors()
+    logging.getLogger().setLevel(logging.WARNING)
+
+def _engine_ping():
+    time.sleep(0.2)  # Tiene occupato il processo, così ogni ping ne avvia uno diverso
+    return os.getpid()
+
+def _engine_probe(url, cookies_path, playlist_end):
+    """Estrae l'info-dict con yt_dlp.YoutubeDL, come yt-dlp -J --flat-playlist --playlist-end."""
+    import yt_dlp
+    options = {
+        "quiet": True, "no_warnings": True, "skip_download": True, "cookiefile": cookies_path,
+        "extract_flat": "in_playlist", "playlistend": playlist_end,
+    }
     try:
-        cmd = ["yt-dlp", "-J", "--cookies", cookies_path, url]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        
-        if result.returncode != 0:
-            raise Exception(f"Errore durante l'esecuzione di yt-dlp: {result.stderr.strip()}")
-        
-        data = json.loads(result.stdout)
+        with yt_dlp.YoutubeDL(options) as ydl:
+            return ydl.sanitize_info(ydl.extract_info(url, download=False)), None
+    except yt_dlp.utils.DownloadError as e:
+        return None, str(e)
+
+def _engine_ytdlp_download(args, info_path, url, events):
+    """Scarica con yt_dlp.YoutubeDL usando le stesse opzioni della riga di comando; file e avanzamento tornano su events."""
+    import yt_dlp
+    from yt_dlp.postprocessor.common import PostProcessor
+
+    class FileReporter(PostProcessor):
+        def run(self, info):
+            events.put(("file", info.get("id"), info.get("filepath")))
+            return [], info
+
+    last_report = [0.0]
+
+    def progress_hook(status):
+        now = time.monotonic()
+        if status.get("status") != "downloading" or now - last_report[0] < 0.5:
+            return
+        last_report[0] = now
+        events.put(("progress", {
+            "downloaded": status.get("downloaded_bytes"),
+            "total": status.get("total_bytes") or status.get("total_bytes_estimate"),
+            "speed": status.get("speed"),
+        }))
+
+    try:
+        options = yt_dlp.parse_options(args).ydl_opts
+        options.update(quiet=True, noprogress=True, no_warnings=True)
+        with yt_dlp.YoutubeDL(options) as ydl:
+            ydl.add_progress_hook(progress_hook)
+            ydl.add_post_processor(FileReporter(), when="after_move")
+            if info_path:
+                ydl.download_with_info_file(info_path)
+            else:
+                ydl.download([url])
+        return None
+    except yt_dlp.utils.DownloadError as e:
+        return str(e)
+    finally:
+        events.put(None)
+
+def _engine_gallery_download(url, cookies_path, workspace, skip, events):
+    """Scarica con l'API dei job di gallery-dl, saltando i primi `skip` media; il percorso di ogni file torna su events."""
+    from gallery_dl import config, job, output
+
+    class EventOutput(output.NullOutput):
+        def skip(self, path):
+            events.put(("file", None, path))
+
+        def success(self, path):
+            events.put(("file", None, path))
+
+    try:
+        # Il processo è riutilizzato: la configurazione va reimpostata a ogni job
+        config.clear()
+        config.set(("extractor",), "cookies", cookies_path)
+        config.set(("extractor",), "base-directory", workspace)
+        if skip:
+            config.set(("extractor",), "image-range", f"{skip + 1}-")
+        output.select = EventOutput
+        status = job.DownloadJob(url).run()
+        return f"gallery-dl ha restituito il codice {status}" if status else None
+    finally:
+        events.put(None)
+
+class InProcessEngine:
+    """Pool di processi già avviati che eseguono yt-dlp e gallery-dl come librerie, senza avviare un interprete per richiesta."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+        self.manager = None
+
+    @property
+    def available(self):
+        return self.pool is not None
+
+    async def start(self):
+        """Avvia e riscalda i processi del pool; in caso di errore resta attivo il percorso a riga di comando."""
+        try:
+            context = multiprocessing.get_context("spawn")
+            self.manager = context.Manager()
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_engine_init)
+            loop = asyncio.get_running_loop()
+            pids = await asyncio.gather(*(loop.run_in_executor(self.pool, _engine_ping) for _ in range(self.workers)))
+            logging.info(f"Motore in-process pronto con {len(set(pids))} processi")
+        except Exception as e:
+            logging.error(f"Impossibile avviare il motore in-process, uso dei comandi yt-dlp/gallery-dl: {e}")
+            self.shutdown()
+
+    async def _call(self, fn, *args, on_event=None):
+        """Esegue fn in un processo del pool inoltrando gli eventi (file, avanzamento) a on_event.
+
+        Solo i guasti del pool (processi terminati, manager irraggiungibile, import non riusciti) diventano
+        EngineUnavailable e portano al ripiego sui comandi. Gli errori di on_event vengono propagati: il download
+        nel pool non deve proseguire mentre un ripiego scarica lo stesso URL nella stessa cartella.
+        """
+        if not self.available:
+            raise EngineUnavailable("motore non avviato")
+        loop = asyncio.get_running_loop()
+        try:
+            events = self.manager.Queue()
+            future = loop.run_in_executor(self.pool, fn, *args, events)
+        except (BrokenProcessPool, RuntimeError, OSError, EOFError) as e:
+            raise EngineUnavailable(str(e)) from e
+        try:
+            while True:
+                try:
+                    event = await loop.run_in_executor(None, functools.partial(events.get, True, 0.5))
+                except queue.Empty:
+                    if future.done():
+                        break
+                    continue
+                except (OSError, EOFError) as e:
+                    raise EngineUnavailable(f"manager non raggiungibile: {e}") from e
+                if event is None:
+                    break
+                if on_event:
+                    await on_event(event)
+            return await future
+        except (BrokenProcessPool, ImportError) as e:
+            raise EngineUnavailable(str(e)) from e
+        finally:
+            if not future.done():
+                future.cancel()
+
+    async def probe(self, url):
+        if not self.available:
+            raise EngineUnavailable("motore non avviato")
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pool, _engine_probe, url, COOKIES_PATH, PLAYLIST_MAX_ITEMS)
+        except Exception as e:
+            raise EngineUnavailable(str(e)) from e
+
+    async def download_ytdlp(self, args, info_path, url, on_event):
+        return await self._call(_engine_ytdlp_download, args, info_path, url, on_event=on_event)
+
+    async def download_gallery(self, url, workspace, on_event, skip=0):
+        return await self._call(_engine_gallery_download, url, COOKIES_PATH, workspace, skip, on_event=on_event)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+        if self.manager is not None:
+            self.manager.shutdown()
+            self.manager = None
+
+engine = InProcessEngine(ENGINE_WORKERS)
+
+class RequestContext:
+    """Contesto di una singola richiesta: URL, modalità e metadati estratti una sola volta con yt-dlp -J."""
+
+    def __init__(self, url, is_audio, job_id=None, item=None):
+        self.url = url
+        self.is_audio = is_audio
+        self.job_id = job_id  # id del job nella coda persistente
+        self.item = item  # posizione dell'elemento nella richiesta (link o voce di playlist)
+        self.info = None  # info-dict di yt-dlp, condiviso da controllo dimensione, download e didascalie
+        self.info_path = None  # info-dict salvato su disco per --load-info-json
+        self.workspace = None  # cartella di lavoro isolata del job
+        self.files = []  # manifest dei file prodotti dal download
+        self.file_ids = {}  # percorso del file -> id del video (per le playlist)
+        self.format_spec = None  # formato scelto dal planner, passato a yt-dlp con -f
+        self.estimated_size = None  # dimensione stimata del formato scelto (o del più piccolo se nessuno rientra)
+        self.audio_format = "mp3"  # formato finale in modalità audio: m4a/mp3 senza ricodifica quando possibile
+        self.media_info = {}  # percorso del video -> larghezza, altezza, durata e miniatura per l'invio
+        self.cache_checked = False  # cache dei file_id già consultata alla ricezione del messaggio
+
+    async def probe(self):
+        """Estrae i metadati una sola volta; le chiamate successive riutilizzano il risultato."""
+        if self.info is not None:
+            return self.info
+        with metrics.span("probe"):
+            return await self._extract()
+
+    async def _extract(self):
+        if engine.available:
+            try:
+                self.info, error = await engine.probe(self.url)
+                if error:
+                    logging.warning(f"Estrazione metadati non riuscita per {self.url}: {error}")
+                return self.info
+            except EngineUnavailable as e:
+                logging.warning(f"Motore in-process non disponibile, uso di yt-dlp -J: {e}")
+        # Le playlist non vengono risolte voce per voce: ogni voce diventa un elemento a sé
+        cmd = ["yt-dlp", "-J", "--flat-playlist", "--playlist-end", str(PLAYLIST_MAX_ITEMS), "--cookies", COOKIES_PATH, self.url]
+        returncode, stdout, stderr = await run_command(cmd)
+        if returncode != 0:
+            logging.warning(f"Estrazione metadati non riuscita per {self.url}: {stderr.strip()}")
+            return None
+        try:
+            self.info = json.loads(stdout)
+        except ValueError as e:
+            logging.error(f"Metadati non validi restituiti da yt-dlp: {e}")
+            return None
+        return self.info
+
+    def cache_key(self):
+        """Chiave della cache dei file_id e dei download in corso: chiave canonica del link + modalità + formato richiesto."""
+        mode = "audio" if self.is_audio else "video"
+        media_format = "auto" if self.is_audio else "mp4"
+        return f"{canonical_key(self.url)}|{mode}|{media_format}"
+
+    @property
+    def is_playlist(self):
+        return bool(self.info) and self.info.get("_type") in ("playlist", "multi_video")
+
+    @property
+    def extractor(self):
+        """Nome dell'extractor, per le metriche."""
+        if self.info and (self.info.get("extractor_key") or self.info.get("extractor")):
+            return self.info.get("extractor_key") or self.info.get("extractor")
+        return "gallery-dl" if "instagram.com/p/" in self.url else "unknown"
+
+    def media_key(self):
+        """Chiave della cache su disco: extractor + id del contenuto + formato scelto. None se i metadati non sono noti."""
+        if not self.info or not self.info.get("id"):
+            return None
+        extractor = self.info.get("extractor_key") or self.info.get("extractor") or "generic"
+        if self.is_audio:
+            media_format = f"audio:{self.format_spec or 'default'}:{self.audio_format}"
+        else:
+            media_format = f"video:{self.format_spec or 'default'}"
+        return f"{extractor}:{self.info['id']}|{media_format}"
+
+    def create_workspace(self):
+        """Crea la cartella di lavoro isolata del job (o del suo elemento) all'interno di DOWNLOAD_DIR."""
+        if self.workspace is None:
+            os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+            if self.job_id is not None:
+                # Nome stabile: dopo un riavvio il job ritrova i download parziali
+                self.workspace = os.path.join(DOWNLOAD_DIR, f"job-{self.job_id}")
+                if self.item is not None:
+                    self.workspace = os.path.join(self.workspace, f"{self.item:03d}")
+                os.makedirs(self.workspace, exist_ok=True)
+            else:
+                self.workspace = tempfile.mkdtemp(prefix="job-", dir=DOWNLOAD_DIR)
+        return self.workspace
+
+    async def set_state(self, state):
+        """Aggiorna lo stato del job nella coda persistente."""
+        if self.job_id is not None:
+            await scheduler.run_blocking(job_queue.set_state, self.job_id, state)
+
+    def write_info_json(self):
+        """Salva l'info-dict nella cartella del job per passarlo a yt-dlp senza nuova estrazione."""
+        if self.info is None:
+            return None
+        if self.info_path is None:
+            self.info_path = os.path.join(self.create_workspace(), "request.info.json")
+            with open(self.info_path, "w") as f:
+                json.dump(self.info, f)
+        return self.info_path
+
+    def filesize(self):
+        """Dimensione dichiarata nei metadati, se presente."""
+        if not self.info:
+            return None
+        for key in ("filesize", "filesize_approx", "filesize_pre"):
+            if self.info.get(key):
+                return self.info[key]
+        return None
+
+    def entry_info(self, filepath):
+        """Metadati della voce di playlist da cui proviene il file, o dell'intero contenuto.
+
+        I file dei post di Instagram (scaricati con gallery-dl) non indicano la voce di provenienza:
+        si usano i metadati del post, con la durata misurata sul file quando è nota.
+        """
+        entry_id = self.file_ids.get(filepath)
+        entries = [entry for entry in (self.info or {}).get("entries") or [] if entry]
+        for entry in entries:
+            if entry_id and entry.get("id") == entry_id:
+                return entry
+        if self.info and "instagram.com/p/" in self.url:
+            info = {key: value for key, value in self.info.items() if key != "entries"}
+            if entries:
+                info.update(entries[0])
+            if self.media_info.get(filepath, {}).get("duration"):
+                info["duration"] = self.media_info[filepath]["duration"]
+            return info
+        return self.info
+
+    def selected_format(self):
+        """Formato dell'info-dict scelto dal planner, se è un formato unico (non una combinazione video+audio)."""
+        for fmt in (self.info or {}).get("formats") or []:
+            if self.format_spec and fmt.get("format_id") == self.format_spec:
+                return fmt
+        return None
+
+    def streamable(self):
+        """True se il formato scelto è un unico MP4 con video e audio entro il limite: non serve merge, si può inviare in streaming."""
+        if not STREAM_UPLOADS or BOT_API_LOCAL_MODE or self.is_audio:
+            return False
+        fmt = self.selected_format()
+        return (
+            fmt is not None and fmt.get("ext") == "mp4"
+            and fmt.get("vcodec") != "none" and fmt.get("acodec") != "none"
+            and bool(self.estimated_size) and self.estimated_size <= MAX_FILE_SIZE * FORMAT_SIZE_MARGIN
+        )
+
+    def plan_format(self, limit):
+        """Sceglie il formato da scaricare in base al limite di upload e ne memorizza la dimensione stimata."""
+        self.format_spec, self.estimated_size = plan_format(self.info, limit)
+        if self.estimated_size is None:
+            self.estimated_size = self.filesize()
+        return self.format_spec
+
+    def plan_audio_format(self, limit):
+        """Sceglie la traccia audio da scaricare e se rimuxarla o convertirla."""
+        self.format_spec, self.estimated_size, self.audio_format = plan_audio_format(self.info, limit)
+        if self.estimated_size is None:
+            self.estimated_size = self.filesize()
+        return self.format_spec
+
+    def close(self):
+        """Elimina la cartella di lavoro del job e tutto il suo contenuto."""
+        if self.workspace and os.path.exists(self.workspace):
+            try:
+                shutil.rmtree(self.workspace)
+                logging.info(f"Cartella del job eliminata: {self.workspace}")
+            except Exception as e:
+                logging.error(f"Errore durante l'eliminazione di {self.workspace}: {e}")
+        self.workspace = None
+        self.info_path = None
+
+def build_video_caption(info, url):
+    """Didascalia dei video costruita dall'info-dict già estratto."""
+    description, duration, uploader, uploader_url, extractor, like_count_formatted = get_video_details(info)
+    uploader_hyperlink = f"[{uploader}]({uploader_url})" if uploader_url else uploader
+    return (
+        f"🔗 [Link {extractor}]({url})\n"
+        f"👤 {uploader_hyperlink}\n"
+        f"🕒 *{duration}* | 👍 *{like_count_formatted}*\n"
+        f"📝 {description}\n"
+    )
+
+def estimate_format_size(fmt, duration):
+    """Dimensione di un formato dall'info-dict, o stima da bitrate × durata se non dichiarata."""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if size:
+        return size
+    bitrate = fmt.get("tbr") or ((fmt.get("vbr") or 0) + (fmt.get("abr") or 0))
+    if bitrate and duration:
+        return int(bitrate * 1000 / 8 * duration)  # tbr/vbr/abr sono in kbit/s
+    return None
+
+def plan_format(info, limit):
+    """Sceglie la migliore combinazione video+audio che rientra nel limite.
+
+    Restituisce (format_spec, dimensione stimata). Se nessun formato rientra restituisce (None, dimensione minima),
+    se le dimensioni non sono stimabili (None, None) e si lascia la scelta a yt-dlp.
+    """
+    if not info or info.get("_type") == "playlist" or not info.get("formats"):
+        return None, None
+    duration = info.get("duration")
+    budget = limit * FORMAT_SIZE_MARGIN
+    videos, audios, candidates = [], [], []
+    for fmt in info["formats"]:
+        if not fmt.get("format_id"):
+            continue
+        size = estimate_format_size(fmt, duration)
+        if size is None:
+            continue
+        has_video = fmt.get("vcodec") != "none"
+        has_audio = fmt.get("acodec") != "none"
+        if has_video and has_audio:
+            candidates.append((fmt["format_id"], size, fmt))
+        elif has_video:
+            videos.append((fmt, size))
+        elif has_audio:
+            audios.append((fmt, size))
+
+    # Per ogni traccia video si abbina il miglior audio che rientra ancora nel limite
+    audios.sort(key=lambda item: (item[0].get("abr") or item[0].get("tbr") or 0), reverse=True)
+    for video, video_size in videos:
+        for audio, audio_size in audios:
+            if video_size + audio_size <= budget:
+                candidates.append((f"{video['format_id']}+{audio['format_id']}", video_size + audio_size, video))
+                break
+        else:
+            if audios:
+                audio, audio_size = min(audios, key=lambda item: item[1])
+                candidates.append((f"{video['format_id']}+{audio['format_id']}", video_size + audio_size, video))
+
+    if not candidates:
+        return None, None
+    fitting = [c for c in candidates if c[1] <= budget]
+    if not fitting:
+        return None, min(c[1] for c in candidates)
+    spec, size, _ = max(fitting, key=lambda c: ((c[2].get("height") or 0), (c[2].get("tbr") or 0), c[1]))
+    return spec, size
+
+def audio_target(acodec):
+    """Formato finale per un codec audio: AAC e MP3 vengono solo rimuxati, gli altri codec convertiti in MP3."""
+    acodec = (acodec or "").lower()
+    if acodec.startswith("mp4a") or acodec == "aac":
+        return "m4a"
+    return "mp3"
+
+def plan_audio_format(info, limit):
+    """Sceglie la migliore traccia solo audio che rientra nel limite e il formato con cui inviarla.
+
+    Restituisce (format_spec, dimensione stimata, formato audio). A parità di qualità si preferiscono AAC e MP3,
+    che Telegram riproduce direttamente e che quindi non richiedono una ricodifica.
+    """
+    if not info or info.get("_type") == "playlist" or not info.get("formats"):
+        return None, None, "mp3"
+    duration = info.get("duration")
+    budget = limit * FORMAT_SIZE_MARGIN
+    audios, progressive = [], []
+    for fmt in info["formats"]:
+        if not fmt.get("format_id") or fmt.get("acodec") == "none":
+            continue
+        size = estimate_format_size(fmt, duration)
+        if fmt.get("vcodec") == "none":
+            audios.append((fmt, size))
+        else:
+            progressive.append((fmt, size))
+
+    if not audios:
+        # Solo formati con video (es. reel): l'audio viene estratto dal formato migliore
+        if not progressive:
+            return None, None, "mp3"
+        best = progressive[-1][0]
+        return None, None, audio_target(best.get("acodec"))
+
+    def quality(item):
+        fmt, _ = item
+        sendable = audio_target(fmt.get("acodec")) == "m4a" or (fmt.get("acodec") or "").startswith("mp3")
+        return (fmt.get("abr") or fmt.get("tbr") or 0) * (1.25 if sendable else 1.0)
+
+    fitting = [item for item in audios if item[1] is None or item[1] <= budget]
+    if not fitting:
+        return None, min(size for _, size in audios), "mp3"
+    fmt, size = max(fitting, key=quality)
+    return fmt["format_id"], size, audio_target(fmt.get("acodec"))
+
+def get_video_details(info):
+    """Recupera dettagli video (descrizione, durata, uploader, uploader_url, extractor, e like_count) dall'info-dict di yt-dlp."""
+    try:
+        if not info:
+            raise Exception("Metadati non disponibili")
+        data = info
         # Tronca la descrizione a 200 caratteri e aggiungi ... se necessario
-        full_description = data.get("description", "Descrizione non disponibile")
+        full_description = data.get("description") or "Descrizione non disponibile"
         description = full_description[:200] + "..." if len(full_description) > 200 else full_description
-        duration_seconds = int(data.get("duration", 0))
+        duration_seconds = int(data.get("duration") or 0)
         duration_formatted = format_duration(duration_seconds)
-        uploader = data.get("uploader", "Uploader sconosciuto")
-        uploader_url = data.get("uploader_url", "")
-        extractor = data.get("extractor", "Extractor sconosciuto")
-        like_count = data.get("like_count", 0)
+        uploader = data.get("uploader") or "Uploader sconosciuto"
+        uploader_url = data.get("uploader_url") or ""
+        extractor = data.get("extractor") or "Extractor sconosciuto"
+        like_count = data.get("like_count") or 0
         like_count_formatted = format_like_count(like_count)
 
         return description, duration_formatted, uploader, uploader_url, extractor, like_count_formatted
@@ -132,80 +1565,301 @@ def format_like_count(number):
     except ValueError:
         return "N/D"  # Valore di default in caso di errore
 
-async def download_content(url, is_audio):
-    """Gestisce il download del contenuto usando yt-dlp o gallery-dl."""
+async def stream_command(cmd, on_stdout, on_stderr):
+    """Esegue un comando esterno passando ogni riga di stdout e stderr alle callback man mano che arriva."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env={**os.environ, "PYTHONUNBUFFERED": "1"}
+    )
+
+    async def pump(stream, callback):
+        async for raw_line in stream:
+            line = raw_line.decode(errors="replace").rstrip("\r\n")
+            if line:
+                await callback(line)
+
+    try:
+        await asyncio.gather(pump(proc.stdout, on_stdout), pump(proc.stderr, on_stderr))
+        return await proc.wait()
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+def parse_progress(line):
+    """Interpreta una riga di avanzamento di yt-dlp prodotta da PROGRESS_TEMPLATE."""
+    fields = line[len(PROGRESS_PREFIX):].split()
+    values = []
+    for field in fields:
+        try:
+            values.append(float(field))
+        except ValueError:
+            values.append(None)  # yt-dlp scrive "NA" per i campi non disponibili
+    values += [None] * (4 - len(values))
+    downloaded, total, total_estimate, speed = values[:4]
+    return {"downloaded": downloaded, "total": total or total_estimate, "speed": speed}
+
+async def list_album_urls(url):
+    """URL diretti dei media di un post, letti con gallery-dl -g senza scaricarli. None se l'album va scaricato con gallery-dl."""
+    returncode, stdout, stderr = await run_command(["gallery-dl", "-g", "--cookies", COOKIES_PATH, url])
+    if returncode != 0:
+        logging.warning(f"Lettura dei media dell'album non riuscita per {url}: {stderr.strip()}")
+        return None
+    # Le righe "| " sono URL alternativi dello stesso media
+    media_urls = [line.strip() for line in stdout.splitlines() if line.strip() and not line.startswith("| ")]
+    # I media che gallery-dl delega a yt-dlp ("ytdl:...") richiedono il download completo
+    if not media_urls or not all(media_url.startswith(("https://", "http://")) for media_url in media_urls):
+        return None
+    return media_urls
+
+def fit_photo(filepath):
+    """Ricomprime in JPEG una foto oltre i limiti di Telegram (10 MB, somma dei lati 10000), ridotta a PHOTO_MAX_SIDE.
+
+    Restituisce il percorso da inviare: lo stesso file se rientra nei limiti, se Pillow non è installato o in caso di errore.
+    """
     try:
+        from PIL import Image
+    except ImportError:
+        return filepath
+    try:
+        with Image.open(filepath) as image:
+            if os.path.getsize(filepath) <= PHOTO_MAX_SIZE and sum(image.size) <= PHOTO_MAX_DIMENSIONS:
+                return filepath
+            original_size = image.size
+            image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+            target = os.path.splitext(filepath)[0] + ".jpg"
+            image.convert("RGB").save(target + ".part", "JPEG", quality=85, optimize=True)
+        os.replace(target + ".part", target)
+        if target != filepath:
+            os.remove(filepath)
+        logging.info(f"Foto ricompressa: {os.path.basename(filepath)} {original_size[0]}x{original_size[1]} -> {humanize.naturalsize(os.path.getsize(target))}")
+        return target
+    except Exception as e:
+        logging.warning(f"Impossibile ricomprimere {filepath}: {e}")
+        with contextlib.suppress(OSError):
+            os.remove(os.path.splitext(filepath)[0] + ".jpg.part")
+        return filepath
+
+async def download_album(workspace, media_urls, on_file, on_progress=None):
+    """Scarica i media di un album al massimo ALBUM_PARALLEL_DOWNLOADS alla volta, passandoli a on_file nell'ordine del post.
+
+    Ogni media viene passato appena pronto, se i precedenti lo sono già: l'invio dei primi gruppi non attende l'intero album.
+    Al primo download non riuscito si ferma; restituisce quanti media sono stati passati a on_file.
+    """
+    slots = asyncio.Semaphore(ALBUM_PARALLEL_DOWNLOADS)
+    downloaded = Counter()  # indice del media -> byte scaricati
+    totals = {}  # indice del media -> dimensione dichiarata
+    started = time.monotonic()
+
+    async def fetch(client, index, media_url):
+        async with slots:
+            async with client.stream("GET", media_url) as response:
+                response.raise_for_status()
+                extension = os.path.splitext(urlsplit(media_url).path)[1].lower()
+                if extension not in PHOTO_EXTENSIONS + VIDEO_EXTENSIONS:
+                    content_type = response.headers.get("content-type", "").split(";")[0]
+                    extension = mimetypes.guess_extension(content_type) or ".jpg"
+                filepath = os.path.join(workspace, f"{index + 1:03d}{extension}")
+                if response.headers.get("content-length", "").isdigit():
+                    totals[index] = int(response.headers["content-length"])
+                f = await scheduler.run_blocking(open, filepath + ".part", "wb")
+                try:
+                    async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                        await scheduler.run_blocking(f.write, chunk)
+                        downloaded[index] += len(chunk)
+                        if on_progress:
+                            await on_progress({
+                                "downloaded": sum(downloaded.values()),
+                                "total": sum(totals.values()) if len(totals) == len(media_urls) else None,
+                                "speed": sum(downloaded.values()) / max(time.monotonic() - started, 1e-6),
+                            })
+                finally:
+                    await scheduler.run_blocking(f.close)
+            await scheduler.run_blocking(os.replace, filepath + ".part", filepath)
+        if RESIZE_PHOTOS and extension in PHOTO_EXTENSIONS:
+            filepath = await scheduler.run_blocking(fit_photo, filepath)
+        return filepath
+
+    async with httpx.AsyncClient(timeout=ALBUM_DOWNLOAD_TIMEOUT, follow_redirects=True) as client:
+        tasks = [asyncio.create_task(fetch(client, index, media_url)) for index, media_url in enumerate(media_urls)]
+        emitted = 0
+        try:
+            for task in tasks:
+                try:
+                    filepath = await task
+                except (httpx.HTTPError, OSError) as e:
+                    logging.warning(f"Download diretto del media {emitted + 1} dell'album non riuscito: {e!r}")
+                    break
+                await on_file(filepath)
+                emitted += 1
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    return emitted
+
+async def download_content(ctx, on_file=None, on_progress=None):
+    """Gestisce il download del contenuto usando yt-dlp o gallery-dl nella cartella di lavoro del job.
+
+    Ogni file completato viene passato subito a on_file, così l'upload può iniziare mentre il download prosegue.
+    Con DOWNLOAD_ENGINE=inprocess il download avviene nei processi già pronti del motore, con i comandi come ripiego.
+    """
+    url = ctx.url
+    stderr_lines = []
+    # Fasi: "download" fino all'ultimo avanzamento ricevuto, poi "postprocess" (merge, estrazione audio) fino al file finale
+    started = time.monotonic()
+    last_progress = None
+
+    async def add_file(filepath):
+        nonlocal started, last_progress
+        if filepath and os.path.isfile(filepath) and filepath not in ctx.files:
+            now = time.monotonic()
+            if last_progress is not None:
+                metrics.stage("download", last_progress - started)
+                metrics.stage("postprocess", now - last_progress)
+            else:
+                metrics.stage("download", now - started)
+            started, last_progress = now, None
+            metrics.inc("yatytb_downloaded_bytes_total", os.path.getsize(filepath))
+            ctx.files.append(filepath)
+            if on_file:
+                await on_file(filepath)
+
+    async def report_progress(progress):
+        nonlocal last_progress
+        last_progress = time.monotonic()
+        if on_progress:
+            await on_progress(progress)
+
+    async def collect_stderr(line):
+        if line.startswith(PROGRESS_PREFIX):
+            await report_progress(parse_progress(line))
+        else:
+            stderr_lines.append(line)
+
+    async def engine_event(event):
+        if event[0] == "file":
+            _, entry_id, filepath = event
+            if entry_id:
+                ctx.file_ids[filepath] = entry_id
+            await add_file(filepath)
+        elif event[0] == "progress":
+            await report_progress(event[1])
+
+    try:
+        workspace = await scheduler.run_blocking(ctx.create_workspace)
         if "instagram.com/p/" in url:
+            # Album: i media vengono scaricati in parallelo dagli URL letti con gallery-dl -g
+            media_urls = await list_album_urls(url) if ALBUM_PARALLEL_DOWNLOADS > 0 else None
+            skip = 0  # Media già scaricati direttamente, esclusi dal download con gallery-dl
+            if media_urls:
+                logging.info(f"Download in parallelo dei {len(media_urls)} media dell'album {url}")
+                skip = await download_album(workspace, media_urls, add_file, report_progress)
+                if skip == len(media_urls):
+                    return ctx.files
+                # Un media non è scaricabile direttamente (es. richiede i cookie): gallery-dl scarica i restanti
+                logging.warning(f"Uso di gallery-dl per i media dell'album dal {skip + 1} in poi")
             # Usa gallery-dl per i post di Instagram
             logging.info("Utilizzo di gallery-dl per il download di un post da Instagram")
+            if engine.available:
+                try:
+                    error = await engine.download_gallery(url, workspace, engine_event, skip)
+                    if error:
+                        raise Exception(f"Errore durante il download con gallery-dl: {error}")
+                    return ctx.files
+                except EngineUnavailable as e:
+                    logging.warning(f"Motore in-process non disponibile, uso di gallery-dl: {e}")
+
             cmd = [
                 "gallery-dl",
                 "--cookies", COOKIES_PATH,
-                "-d", DOWNLOAD_DIR,
-                url
+                "-d", workspace,
             ]
-            result = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await result.communicate()
-            logging.info(f"Output di gallery-dl:\n{stdout.decode()}\n{stderr.decode()}")
-
-            if result.returncode != 0:
-                raise Exception(f"Errore durante il download con gallery-dl: {stderr.decode()}")
-
-            # Ritorna solo i file scaricati, ignorando le directory
-            return sorted(
-                [
-                    os.path.join(root, file)
-                    for root, _, files in os.walk(DOWNLOAD_DIR)
-                    for file in files
-                ],
-                key=os.path.getmtime,
-                reverse=True
-            )
+            if skip:
+                cmd += ["--range", f"{skip + 1}-"]
+            cmd.append(url)
+
+            async def gallery_file(line):
+                # gallery-dl stampa il percorso di ogni file scaricato; con "# " quelli già presenti
+                await add_file(line[2:] if line.startswith("# ") else line)
+
+            returncode = await stream_command(cmd, gallery_file, collect_stderr)
+            stderr = "\n".join(stderr_lines)
+            logging.info("Output di gallery-dl:\n%s\n%s", "\n".join(ctx.files), stderr)
+
+            if returncode != 0:
+                raise Exception(f"Errore durante il download con gallery-dl: {stderr}")
         else:
             # Usa yt-dlp per reel di Instagram e altri URL
-            output_template = os.path.join(DOWNLOAD_DIR, '%(title).80s.%(ext)s')
-            ytdlp_cmd = [
-                "yt-dlp",
+            output_template = os.path.join(workspace, '%(title).80s.%(ext)s')
+            ytdlp_args = [
                 "--cookies", COOKIES_PATH,
                 "--merge-output-format", "mp4",  # Separato correttamente
                 "-o", output_template,
-                url
             ]
 
-            if is_audio:
-                ytdlp_cmd += ["-x", "--audio-format", "mp3"]
+            if ctx.format_spec:
+                ytdlp_args += ["-f", ctx.format_spec]
+
+            if ctx.is_audio:
+                # AAC e MP3 vengono solo rimuxati (nessuna ricodifica), gli altri codec convertiti
+                ytdlp_args += ["-x", "--audio-format", ctx.audio_format]
+
+            # Riutilizza i metadati già estratti invece di ripetere l'estrazione
+            info_path = await scheduler.run_blocking(ctx.write_info_json)
+
+            if engine.available:
+                try:
+                    error = await engine.download_ytdlp(ytdlp_args, info_path, url, engine_event)
+                    if error:
+                        raise Exception(f"Errore durante il download con yt-dlp: {error}")
+                    return ctx.files
+                except EngineUnavailable as e:
+                    logging.warning(f"Motore in-process non disponibile, uso di yt-dlp: {e}")
+
+            ytdlp_cmd = ["yt-dlp"] + ytdlp_args + [
+                # Stampa id e percorso finale di ogni file, dopo merge e post-processing
+                "--print", f"after_move:{FILE_PREFIX}%(id)s\t%(filepath)s",
+                # Avanzamento su righe separate e in formato leggibile dal bot
+                "--progress", "--newline",
+                "--progress-template", f"download:{PROGRESS_TEMPLATE}",
+            ]
+            if info_path:
+                ytdlp_cmd += ["--load-info-json", info_path]
+            else:
+                ytdlp_cmd.append(url)
+
+            async def ytdlp_file(line):
+                if line.startswith(FILE_PREFIX):
+                    entry_id, _, filepath = line[len(FILE_PREFIX):].partition("\t")
+                    ctx.file_ids[filepath] = entry_id
+                    await add_file(filepath)
 
             logging.info(f"Esecuzione di yt-dlp: {' '.join(ytdlp_cmd)}")
-            proc = await asyncio.create_subprocess_exec(
-                *ytdlp_cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await proc.communicate()
-            logging.info(f"yt-dlp output:\n{stdout.decode()}\n{stderr.decode()}")
+            returncode = await stream_command(ytdlp_cmd, ytdlp_file, collect_stderr)
+            stderr = "\n".join(stderr_lines)
+            logging.info("yt-dlp output:\n%s\n%s", "\n".join(ctx.files), stderr)
 
-            if "ERROR:" in stderr.decode():
+            if "ERROR:" in stderr:
                 raise Exception("Errore durante il download con yt-dlp")
-
-            return sorted(
-                [os.path.join(DOWNLOAD_DIR, f) for f in os.listdir(DOWNLOAD_DIR) if os.path.isfile(os.path.join(DOWNLOAD_DIR, f))],
-                key=os.path.getmtime,
-                reverse=True
-            )
+        return ctx.files
     except Exception as e:
         logging.error(f"Errore durante il download: {e}")
         return []
 
-async def cleanup_download_dir():
-    """Pulisce la cartella dei download all'avvio."""
+async def cleanup_download_dir(keep=()):
+    """Pulisce la cartella dei download all'avvio, conservando le cartelle dei job da riprendere e la cache su disco."""
     try:
         if os.path.exists(DOWNLOAD_DIR):
             for filename in os.listdir(DOWNLOAD_DIR):
+                if filename in keep:
+                    logging.info(f"Cartella conservata per la ripresa del job: {filename}")
+                    continue
                 file_path = os.path.join(DOWNLOAD_DIR, filename)
+                if os.path.abspath(file_path) == os.path.abspath(MEDIA_CACHE_DIR):
+                    continue
                 try:
                     if os.path.isfile(file_path) or os.path.islink(file_path):
                         os.remove(file_path)
@@ -221,114 +1875,677 @@ async def cleanup_download_dir():
     except Exception as e:
         logging.error(f"Errore durante la pulizia iniziale della cartella {DOWNLOAD_DIR}: {e}")
 
-async def send_large_file(update: Update, filepath: str, caption: str, is_video: bool = False):
-    """Gestisce l'invio di file grandi in chunk."""
-    temp_files = []  # Lista per tenere traccia dei file temporanei
+def media_input(filepath, stack):
+    """Prepara un file per l'invio: percorso (file://) col server locale, altrimenti un handle chiuso a fine invio."""
+    if BOT_API_LOCAL_MODE:
+        # Il server locale legge il file direttamente dal disco condiviso: nessuna copia in memoria
+        return Path(filepath)
+    return stack.enter_context(open(filepath, "rb"))
+
+async def probe_duration(filepath):
+    """Durata in secondi di un file multimediale, letta con ffprobe."""
+    cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", filepath]
+    returncode, stdout, stderr = await run_command(cmd)
+    if returncode != 0:
+        raise Exception(f"Errore durante l'esecuzione di ffprobe: {stderr.strip()}")
+    return float(stdout.strip())
+
+def moov_at_start(filepath):
+    """True se nel file MP4/MOV il moov atom precede i dati (mdat), cioè se la riproduzione può iniziare subito.
+
+    Legge solo le intestazioni dei box di primo livello, senza analizzare il contenuto.
+    """
+    with open(filepath, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            header = f.read(16)
+            size, box_type = int.from_bytes(header[:4], "big"), header[4:8]
+            if size == 1 and len(header) >= 16:
+                size = int.from_bytes(header[8:16], "big")  # Dimensione a 64 bit
+            elif size == 0:
+                size = file_size - offset  # Il box arriva fino alla fine del file
+            if box_type == b"moov":
+                return True
+            if box_type == b"mdat" or size < 8:
+                return False
+            offset += size
+    return False
+
+async def probe_media(filepath):
+    """Dimensioni e durata di un video lette con una sola esecuzione di ffprobe (tiene conto della rotazione)."""
+    cmd = ["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", "-select_streams", "v:0", filepath]
+    returncode, stdout, stderr = await run_command(cmd)
+    if returncode != 0:
+        raise Exception(f"Errore durante l'esecuzione di ffprobe: {stderr.strip()}")
+    data = json.loads(stdout or "{}")
+    meta = {}
+    duration = (data.get("format") or {}).get("duration")
+    if duration:
+        meta["duration"] = float(duration)
+    for stream in data.get("streams") or []:
+        width, height = stream.get("width"), stream.get("height")
+        rotation = (stream.get("tags") or {}).get("rotate")
+        for side_data in stream.get("side_data_list") or []:
+            rotation = side_data.get("rotation", rotation)
+        if width and height:
+            if rotation is not None and abs(int(float(rotation))) % 180 == 90:
+                width, height = height, width  # Video verticale registrato ruotato
+            meta["width"], meta["height"] = width, height
+    return meta
+
+async def prepare_video(filepath):
+    """Prepara un video per Telegram con un solo ffprobe e un solo ffmpeg.
+
+    Sposta il moov atom in testa (remux senza ricodifica) se serve, estrae una miniatura e restituisce
+    larghezza, altezza, durata e percorso della miniatura da passare alle chiamate di invio.
+    Gli errori vengono solo registrati: il video viene comunque inviato, con i metadati disponibili.
+    """
+    try:
+        meta = await probe_media(filepath)
+    except Exception as e:
+        logging.error(f"Metadati del video {filepath} non disponibili: {e}")
+        return {}
+    if "width" not in meta:
+        return meta  # Nessuna traccia video: niente miniatura
+    base, ext = os.path.splitext(filepath)
+    thumbnail = f"{base}.thumb.jpg"
+    # Miniatura da un fotogramma poco dopo l'inizio, spesso nero nei primi istanti
+    offset = min(5.0, meta.get("duration", 0) / 10)
+    scale = f"scale={THUMBNAIL_SIZE}:{THUMBNAIL_SIZE}:force_original_aspect_ratio=decrease"
+    thumbnail_output = ["-map", "0:v:0", "-frames:v", "1", "-q:v", "5", thumbnail]
+    # Miniatura decodificando dal punto di seek: funziona anche con keyframe radi
+    seek_cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+        "-ss", f"{offset:.2f}", "-i", filepath,
+        "-vf", scale, *thumbnail_output,
+    ]
+    remux = ext.lower() in FASTSTART_EXTENSIONS and not await scheduler.run_blocking(moov_at_start, filepath)
+    if remux:
+        # Un solo passaggio: copia dei flussi con faststart e miniatura. Il decoder legge solo i keyframe,
+        # così la miniatura non costa la decodifica dell'intero video
+        remuxed = f"{base}.faststart{ext}"
+        cmd = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+            "-skip_frame", "nokey", "-i", filepath,
+            "-map", "0", "-c", "copy", "-movflags", "+faststart", remuxed,
+            "-vf", f"select='gte(t,{offset:.2f})',{scale}", *thumbnail_output,
+        ]
+    else:
+        cmd = seek_cmd
+    try:
+        with metrics.span("postprocess"):
+            returncode, _, stderr = await run_command(cmd)
+    except OSError as e:
+        returncode, stderr = None, str(e)  # ffmpeg non disponibile
+    if returncode != 0:
+        logging.error(f"Errore durante la preparazione del video {filepath}: {stderr.strip()}")
+        if remux and os.path.exists(remuxed):
+            os.remove(remuxed)
+        return meta
+    if remux:
+        await scheduler.run_blocking(os.replace, remuxed, filepath)
+        logging.info(f"Moov atom spostato in testa: {filepath}")
+        if not os.path.isfile(thumbnail):
+            # Nessun keyframe dopo l'offset (keyframe radi): ffmpeg termina senza errori ma senza miniatura
+            with metrics.span("postprocess"):
+                returncode, _, stderr = await run_command(seek_cmd)
+            if returncode != 0:
+                logging.warning(f"Miniatura non disponibile per {filepath}: {stderr.strip()}")
+    if os.path.isfile(thumbnail):
+        meta["thumbnail"] = thumbnail
+    return meta
+
+async def split_video(filepath, limit, duration=None):
+    """Divide un video in parti riproducibili (tagli sui keyframe, stream copy senza ricodifica).
+
+    La durata delle parti è calcolata dal bitrate medio in modo che ognuna rientri nel limite.
+    Le parti vengono restituite man mano che ffmpeg le completa, così l'upload può iniziare subito.
+    """
+    file_size = os.path.getsize(filepath)
+    if not duration:
+        duration = await probe_duration(filepath)
+    part_duration = max(1.0, duration * (limit * SPLIT_SIZE_MARGIN) / file_size)
+    total_parts = max(1, int(-(-duration // part_duration)))
+    base, ext = os.path.splitext(filepath)
+    output_pattern = f"{base}.part%03d{ext}"
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin",
+        "-i", filepath,
+        "-map", "0", "-c", "copy",
+        "-f", "segment",
+        "-segment_time", f"{part_duration:.3f}",
+        "-reset_timestamps", "1",
+        # ffmpeg scrive il nome di ogni parte su stdout appena la chiude
+        "-segment_list", "pipe:1", "-segment_list_type", "flat",
+    ]
+    if ext.lower() in FASTSTART_EXTENSIONS:
+        # Ogni parte riproducibile prima della fine del download
+        cmd += ["-segment_format_options", "movflags=+faststart"]
+    cmd.append(output_pattern)
+    logging.info(f"Suddivisione di {filepath} in ~{total_parts} parti da {part_duration:.0f} secondi")
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stderr_task = asyncio.create_task(proc.stderr.read())
+    try:
+        async for line in proc.stdout:
+            part = line.decode(errors="replace").strip()
+            if not part:
+                continue
+            if not os.path.isabs(part):
+                part = os.path.join(os.path.dirname(filepath), part)
+            yield part, total_parts
+        await proc.wait()
+        stderr = (await stderr_task).decode(errors="replace")
+        if proc.returncode != 0:
+            raise Exception(f"Errore durante la suddivisione con ffmpeg: {stderr.strip()}")
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        stderr_task.cancel()
+
+async def split_video_within(filepath, limit, duration=None, depth=0):
+    """Come split_video, ma verifica la dimensione di ogni parte: -segment_time è solo un minimo, ffmpeg taglia
+    al keyframe successivo e con keyframe radi una parte può superare il limite. Queste parti vengono divise di nuovo
+    (ricalcolando la durata dal loro bitrate); se non basta, l'elemento fallisce con un errore per l'utente.
+    """
+    extra = 0  # Parti in più rispetto alla stima, dovute alle nuove suddivisioni
+    async with contextlib.aclosing(split_video(filepath, limit, duration)) as parts:
+        async for part_path, total_parts in parts:
+            part_size = os.path.getsize(part_path)
+            if part_size <= limit:
+                yield part_path, total_parts + extra
+                continue
+            try:
+                if depth >= SPLIT_MAX_DEPTH:
+                    raise ItemError(
+                        f"⚠️ Impossibile dividere il video in parti da {humanize.naturalsize(limit)}: "
+                        f"i keyframe sono troppo distanti."
+                    )
+                logging.warning(f"Parte {part_path} oltre il limite ({humanize.naturalsize(part_size)}): nuova suddivisione")
+                first = True
+                async with contextlib.aclosing(split_video_within(part_path, limit, None, depth + 1)) as subparts:
+                    async for subpart_path, subparts_total in subparts:
+                        if first:
+                            extra += subparts_total - 1
+                            first = False
+                        yield subpart_path, total_parts + extra
+            finally:
+                with contextlib.suppress(OSError):
+                    os.remove(part_path)
+
+def retry_after_seconds(error: RetryAfter):
+    """Attesa richiesta da Telegram in secondi (secondo la versione della libreria può essere un intero o un timedelta)."""
+    delay = error.retry_after
+    return delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+
+class TokenBucket:
+    """Token bucket: `rate` invii al secondo, con picchi fino a `capacity`. Può essere sospeso dopo un RetryAfter."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, cost, now):
+        """Secondi da attendere prima di poter spendere `cost` token (0 se disponibili subito)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # Un invio più costoso della capacità (es. un media group) parte a bucket pieno e lo lascia in debito
+        needed = min(cost, self.capacity)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < needed:
+            wait = max(wait, (needed - self.tokens) / self.rate)
+        return wait
+
+    def take(self, cost):
+        self.tokens -= cost
+
+    def pause(self, seconds):
+        """Blocca il bucket per il tempo indicato da Telegram."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0)
+
+class OutboundScheduler:
+    """Punto unico delle chiamate verso Telegram.
+
+    Ogni chiamata attende un token del bucket della propria chat e di quello globale; tra le chiamate
+    in attesa passano prima reazioni e messaggi brevi, poi gli upload. Gli errori di rete vengono
+    ritentati con backoff esponenziale, i RetryAfter attendendo il tempo indicato da Telegram.
+    """
+
+    def __init__(self, global_rate, chat_rate, chat_burst, max_uploads):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.waiters = []  # (priorità, sequenza, chat_id, costo, future)
+        self.sequence = itertools.count()
+        self.upload_slots = asyncio.Semaphore(max_uploads)
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _grant(self):
+        """Concede i token ai richiedenti in ordine di priorità. Restituisce i secondi fino al prossimo controllo utile."""
+        now = time.monotonic()
+        next_check = None
+        blocked_chats = set()
+        for waiter in sorted(self.waiters, key=lambda w: (w[0], w[1])):
+            _, _, chat_id, cost, future = waiter
+            if future.done():  # richiesta annullata
+                self.waiters.remove(waiter)
+                continue
+            if chat_id in blocked_chats:
+                continue  # Nella stessa chat si rispetta l'ordine
+            global_wait = self.global_bucket.delay(cost, now)
+            wait = max(global_wait, self._chat_bucket(chat_id).delay(cost, now))
+            if wait > 0:
+                next_check = wait if next_check is None else min(next_check, wait)
+                if global_wait > 0:
+                    break  # I token globali liberati andranno alle richieste più prioritarie
+                blocked_chats.add(chat_id)
+                continue
+            self.global_bucket.take(cost)
+            self._chat_bucket(chat_id).take(cost)
+            self.waiters.remove(waiter)
+            future.set_result(None)
+        return next_check
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            timeout = self._grant()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, chat_id, priority, cost):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((priority, next(self.sequence), chat_id, cost, future))
+        self.wakeup.set()
+        await future
+
+    async def call(self, chat_id, fn, priority=PRIORITY_TEXT, cost=1):
+        """Esegue `fn()` rispettando limiti e priorità, ritentando in caso di errore.
+
+        `fn` crea una nuova coroutine a ogni tentativo, così i file da caricare vengono riaperti da capo.
+        """
+        slots = self.upload_slots if priority >= PRIORITY_UPLOAD else contextlib.nullcontext()
+        async with slots:
+            for attempt in range(MAX_RETRIES):
+                await self._acquire(chat_id, priority, cost)
+                try:
+                    if priority < PRIORITY_UPLOAD:
+                        return await fn()
+                    with metrics.span("upload"):
+                        return await fn()
+                except RetryAfter as e:
+                    delay = retry_after_seconds(e)
+                    logging.warning(f"Limite di invio raggiunto nella chat {chat_id}: nuovo tentativo tra {delay:.0f} secondi")
+                    if attempt == MAX_RETRIES - 1:
+                        raise
+                    metrics.inc("yatytb_send_retries_total", reason="retry_after")
+                    # La chat resta bloccata per il tempo indicato, anche per gli altri invii in coda
+                    self._chat_bucket(chat_id).pause(delay)
+                except BadRequest:
+                    raise  # Richiesta non valida: ritentare non serve
+                except (TimedOut, NetworkError) as e:
+                    logging.error(f"Errore di rete durante l'invio nella chat {chat_id} (tentativo {attempt + 1}/{MAX_RETRIES}): {e}")
+                    if attempt == MAX_RETRIES - 1:
+                        raise
+                    metrics.inc("yatytb_send_retries_total", reason="timeout" if isinstance(e, TimedOut) else "network")
+                    await asyncio.sleep(min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** attempt))
+
+    def shutdown(self):
+        if self.task is not None:
+            self.task.cancel()
+
+outbound = OutboundScheduler(GLOBAL_SEND_RATE, CHAT_SEND_RATE, CHAT_SEND_BURST, MAX_CONCURRENT_UPLOADS)
+metrics.describe("yatytb_send_queue", "gauge", "Chiamate a Telegram in attesa di un token", lambda: [({}, len(outbound.waiters))])
+
+async def react(bot, chat_id, message_id, emoji):
+    """Aggiunge una reazione a un messaggio con la massima priorità; gli errori vengono solo registrati."""
+    try:
+        await outbound.call(chat_id, lambda: bot.set_message_reaction(chat_id, message_id, emoji), PRIORITY_REACTION)
+    except Exception as e:
+        logging.error(f"Errore durante l'aggiunta della reazione {emoji}: {e}")
+
+class StreamError(Exception):
+    """Upload in streaming interrotto da un errore locale (yt-dlp, dimensione): i byte inviati non formano un file valido."""
+
+def reply_fields(message: Message, caption):
+    """Campi di una risposta inviata direttamente alla Bot API; come reply_* cita il messaggio solo fuori dalle chat private."""
+    fields = {"chat_id": message.chat.id, "parse_mode": ParseMode.MARKDOWN}
+    if caption:
+        fields["caption"] = caption
+    if message.chat.type != Chat.PRIVATE:
+        fields["reply_parameters"] = json.dumps({"message_id": message.message_id})
+    return fields
+
+async def upload_multipart(message: Message, method, fields, file_field, filename, chunks, length=None, attachments=None):
+    """Invia un file alla Bot API con un corpo multipart prodotto a blocchi da `chunks`, senza tenerlo in memoria.
+
+    Con `length` noto la richiesta ha un Content-Length, altrimenti usa il transfer encoding chunked.
+    `attachments` (nome -> percorso) aggiunge file piccoli, come le miniature, letti interamente.
+    Le risposte di errore diventano le eccezioni della libreria, gestite dallo scheduler degli invii come le altre.
+    """
+    bot = message.get_bot()
+    boundary = uuid.uuid4().hex
+    filename = filename.replace('"', "'").replace("\r", " ").replace("\n", " ")
+    head = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in fields.items()
+    )
+    for name, path in (attachments or {}).items():
+        with open(path, "rb") as f:
+            head += (
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{os.path.basename(path)}"\r\n'
+                f"Content-Type: application/octet-stream\r\n\r\n"
+            ).encode() + f.read() + b"\r\n"
+    head += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    async def body():
+        yield head
+        async for chunk in chunks:
+            yield chunk
+        yield tail
+
+    headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    if length is not None:
+        headers["Content-Length"] = str(len(head) + length + len(tail))
+    try:
+        async with httpx.AsyncClient(timeout=UPLOAD_TIMEOUT) as client:
+            response = await client.post(f"{bot.base_url}/{method}", content=body(), headers=headers)
+    except httpx.TimeoutException as e:
+        raise TimedOut(f"upload non riuscito: {e}") from e
+    except httpx.HTTPError as e:
+        raise NetworkError(f"upload non riuscito: {e}") from e
+    try:
+        data = response.json()
+    except ValueError:
+        raise NetworkError(f"risposta non valida dalla Bot API (HTTP {response.status_code})")
+    if data.get("ok"):
+        return Message.de_json(data["result"], bot)
+    description = data.get("description") or f"HTTP {response.status_code}"
+    retry_after = (data.get("parameters") or {}).get("retry_after")
+    if retry_after is not None:
+        raise RetryAfter(retry_after)
+    if response.status_code == 400:
+        raise BadRequest(description)
+    if response.status_code in (401, 403):
+        raise Forbidden(description)
+    raise NetworkError(description)
+
+async def file_chunks(filepath):
+    """Legge un file a blocchi di STREAM_CHUNK_SIZE fuori dall'event loop."""
+    with open(filepath, "rb") as f:
+        while chunk := await scheduler.run_blocking(f.read, STREAM_CHUNK_SIZE):
+            yield chunk
+
+async def stream_video(message: Message, ctx, caption, on_progress=None):
+    """Scarica un video con yt-dlp su stdout (-o -) e lo carica su Telegram man mano, senza file temporanei.
+
+    Tra download e upload restano al massimo STREAM_BUFFER_SIZE byte: se l'upload rallenta, la pipe ferma yt-dlp.
+    Ogni tentativo dello scheduler degli invii riparte da un nuovo download.
+    """
+    info_path = await scheduler.run_blocking(ctx.write_info_json)
+    cmd = [
+        "yt-dlp",
+        "--cookies", COOKIES_PATH,
+        "-f", ctx.format_spec,
+        "-o", "-",
+        "--progress", "--newline",
+        "--progress-template", f"download:{PROGRESS_TEMPLATE}",
+    ]
+    cmd += ["--load-info-json", info_path] if info_path else [ctx.url]
+    # Il lettore di asyncio sospende la pipe quando il buffer supera il doppio del limite
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=max(64 * 1024, STREAM_BUFFER_SIZE // 2),
+        env={**os.environ, "PYTHONUNBUFFERED": "1"}
+    )
+    stderr_lines = []
+
+    async def read_stderr():
+        # Con -o - yt-dlp scrive messaggi e avanzamento su stderr
+        async for raw_line in proc.stderr:
+            line = raw_line.decode(errors="replace").rstrip("\r\n")
+            if line.startswith(PROGRESS_PREFIX):
+                if on_progress:
+                    await on_progress(parse_progress(line))
+            elif line:
+                stderr_lines.append(line)
+
+    stderr_task = asyncio.create_task(read_stderr())
+    streamed = 0
+
+    async def chunks():
+        nonlocal streamed
+        while chunk := await proc.stdout.read(STREAM_CHUNK_SIZE):
+            streamed += len(chunk)
+            if streamed > MAX_FILE_SIZE:
+                raise StreamError(f"il video supera il limite di {humanize.naturalsize(MAX_FILE_SIZE)}")
+            yield chunk
+        await stderr_task
+        if await proc.wait() != 0:
+            # Senza la chiusura del multipart Telegram scarta il file parziale
+            raise StreamError(f"errore di yt-dlp: {' '.join(stderr_lines[-3:])}")
+
+    fields = reply_fields(message, caption)
+    fields["supports_streaming"] = "true"
+    fmt = ctx.selected_format() or {}
+    for key in ("width", "height"):
+        if fmt.get(key):
+            fields[key] = int(fmt[key])
+    if (ctx.info or {}).get("duration"):
+        fields["duration"] = int(ctx.info["duration"])
+    try:
+        sent = await upload_multipart(message, "sendVideo", fields, "video", f"{ctx.info.get('id', 'video')}.mp4", chunks())
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        stderr_task.cancel()
+        await asyncio.gather(stderr_task, return_exceptions=True)
+    metrics.inc("yatytb_downloaded_bytes_total", streamed)
+    metrics.inc("yatytb_uploaded_bytes_total", streamed)
+    logging.info(f"Video inviato in streaming da yt-dlp: {ctx.url} ({humanize.naturalsize(streamed)})")
+    return sent
+
+def video_params(meta, stack):
+    """Parametri di invio di un video preparato: dimensioni, durata e miniatura (aperta fino alla fine dell'invio)."""
+    params = {key: int(round(meta[key])) for key in ("width", "height", "duration") if meta.get(key)}
+    if meta.get("thumbnail"):
+        # Le miniature vanno sempre caricate, anche con il server locale
+        params["thumbnail"] = stack.enter_context(open(meta["thumbnail"], "rb"))
+    return params
+
+async def send_file(message: Message, filepath: str, caption, is_video: bool, meta=None):
+    """Invia un singolo file come video o documento tramite lo scheduler degli invii, che gestisce i tentativi.
+
+    `meta` contiene i metadati del video preparato da prepare_video (dimensioni, durata, miniatura).
+    """
+    meta = meta or {}
+
+    async def upload():
+        if STREAM_UPLOADS and not BOT_API_LOCAL_MODE:
+            # Corpo letto dal disco a blocchi: la memoria non cresce con la dimensione del file
+            fields = reply_fields(message, caption)
+            attachments = {}
+            if is_video:
+                fields["supports_streaming"] = "true"
+                fields.update({key: int(round(meta[key])) for key in ("width", "height", "duration") if meta.get(key)})
+                if meta.get("thumbnail"):
+                    fields["thumbnail"] = "attach://thumbnail_file"
+                    attachments["thumbnail_file"] = meta["thumbnail"]
+            return await upload_multipart(
+                message, "sendVideo" if is_video else "sendDocument", fields, "video" if is_video else "document",
+                os.path.basename(filepath), file_chunks(filepath), os.path.getsize(filepath), attachments
+            )
+        with contextlib.ExitStack() as stack:
+            file = media_input(filepath, stack)
+            if is_video:
+                return await message.reply_video(
+                    file,
+                    caption=caption,
+                    parse_mode=ParseMode.MARKDOWN,
+                    supports_streaming=True,
+                    **video_params(meta, stack),
+                    read_timeout=UPLOAD_TIMEOUT,
+                    write_timeout=UPLOAD_TIMEOUT,
+                    connect_timeout=UPLOAD_TIMEOUT,
+                    pool_timeout=UPLOAD_TIMEOUT
+                )
+            return await message.reply_document(
+                file,
+                caption=caption,
+                parse_mode=ParseMode.MARKDOWN,
+                read_timeout=UPLOAD_TIMEOUT,
+                write_timeout=UPLOAD_TIMEOUT,
+                connect_timeout=UPLOAD_TIMEOUT,
+                pool_timeout=UPLOAD_TIMEOUT
+            )
+    sent = await outbound.call(message.chat.id, upload, PRIORITY_UPLOAD)
+    metrics.inc("yatytb_uploaded_bytes_total", os.path.getsize(filepath))
+    return sent
+
+async def send_large_file(message: Message, filepath: str, caption: str, is_video: bool = False, meta=None):
+    """Invia un file oltre il limite dividendolo in parti video riproducibili, caricate man mano che vengono prodotte.
+
+    Le parti ereditano dimensioni e miniatura del video originale (`meta`). Restituisce la lista dei messaggi
+    inviati, oppure None in caso di errore.
+    """
+    meta = meta or {}
     start_time = time.time()
+    messages = []
     try:
         file_size = os.path.getsize(filepath)
         logging.info(f"Inizio invio file grande: {filepath} ({humanize.naturalsize(file_size)})")
-        
-        if file_size <= CHUNK_SIZE:
-            # Se il file è piccolo, invialo normalmente
-            with open(filepath, "rb") as file:
-                if is_video:
-                    await update.message.reply_video(
-                        file, 
-                        caption=caption, 
-                        parse_mode=ParseMode.MARKDOWN,
-                        read_timeout=UPLOAD_TIMEOUT,
-                        write_timeout=UPLOAD_TIMEOUT,
-                        connect_timeout=UPLOAD_TIMEOUT,
-                        pool_timeout=UPLOAD_TIMEOUT
-                    )
-                else:
-                    await update.message.reply_document(
-                        file, 
-                        caption=caption, 
-                        parse_mode=ParseMode.MARKDOWN,
-                        read_timeout=UPLOAD_TIMEOUT,
-                        write_timeout=UPLOAD_TIMEOUT,
-                        connect_timeout=UPLOAD_TIMEOUT,
-                        pool_timeout=UPLOAD_TIMEOUT
-                    )
-            return True
 
-        # Per file grandi, dividi in chunk
-        with open(filepath, "rb") as file:
-            total_chunks = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
-            for i in range(0, file_size, CHUNK_SIZE):
-                chunk_start_time = time.time()
-                chunk = file.read(CHUNK_SIZE)
-                temp_chunk = tempfile.NamedTemporaryFile(delete=False)
-                temp_chunk.write(chunk)
-                temp_chunk.close()
-                temp_chunk_path = temp_chunk.name
-                temp_files.append(temp_chunk_path)
-
-                chunk_size = len(chunk)
-                chunk_number = (i // CHUNK_SIZE) + 1
-                logging.info(f"Invio chunk {chunk_number}/{total_chunks} ({humanize.naturalsize(chunk_size)})")
-
-                for attempt in range(MAX_RETRIES):
-                    try:
-                        if not os.path.exists(temp_chunk_path):
-                            raise FileNotFoundError(f"File temporaneo non trovato: {temp_chunk_path}")
-                            
-                        with open(temp_chunk_path, "rb") as chunk_file:
-                            if is_video:
-                                await update.message.reply_video(
-                                    chunk_file,
-                                    caption=caption if i == 0 else None,
-                                    parse_mode=ParseMode.MARKDOWN,
-                                    read_timeout=UPLOAD_TIMEOUT,
-                                    write_timeout=UPLOAD_TIMEOUT,
-                                    connect_timeout=UPLOAD_TIMEOUT,
-                                    pool_timeout=UPLOAD_TIMEOUT
-                                )
-                            else:
-                                await update.message.reply_document(
-                                    chunk_file,
-                                    caption=caption if i == 0 else None,
-                                    parse_mode=ParseMode.MARKDOWN,
-                                    read_timeout=UPLOAD_TIMEOUT,
-                                    write_timeout=UPLOAD_TIMEOUT,
-                                    connect_timeout=UPLOAD_TIMEOUT,
-                                    pool_timeout=UPLOAD_TIMEOUT
-                                )
-                        chunk_time = time.time() - chunk_start_time
-                        logging.info(f"Chunk {chunk_number}/{total_chunks} inviato in {chunk_time:.2f} secondi")
-                        break
-                    except TimedOut as e:
-                        logging.error(f"Timeout durante l'invio del chunk {chunk_number}/{total_chunks}: {e}")
-                        if attempt == MAX_RETRIES - 1:
-                            raise
-                        await asyncio.sleep(RETRY_DELAY * (attempt + 1))  # Aumenta il delay ad ogni tentativo
-                    except (TelegramError, NetworkError) as e:
-                        logging.error(f"Errore di rete durante l'invio del chunk {chunk_number}/{total_chunks}: {e}")
-                        if attempt == MAX_RETRIES - 1:
-                            raise
-                        await asyncio.sleep(RETRY_DELAY * (attempt + 1))
-                    except Exception as e:
-                        logging.error(f"Errore durante l'invio del chunk {chunk_number}/{total_chunks}: {e}")
-                        raise
+        if file_size <= MAX_FILE_SIZE:
+            # Se il file rientra nel limite, invialo normalmente
+            messages.append(await send_file(message, filepath, caption, is_video, meta))
+            return messages
+
+        if not is_video:
+            # Le porzioni di byte di un file generico non sono utilizzabili su Telegram
+            raise Exception("solo i video possono essere divisi in parti")
+
+        part_number = 0
+        part_meta = {key: meta[key] for key in ("width", "height", "thumbnail") if meta.get(key)}
+        async with contextlib.aclosing(split_video_within(filepath, MAX_FILE_SIZE, meta.get("duration"))) as parts:
+            split_start = time.monotonic()
+            async for part_path, total_parts in parts:
+                # Attesa della parte da ffmpeg (l'upload delle parti è misurato a parte)
+                metrics.stage("postprocess", time.monotonic() - split_start)
+                part_number += 1
+                part_start_time = time.time()
+                part_size = os.path.getsize(part_path)
+                logging.info(f"Invio parte {part_number}/{total_parts} ({humanize.naturalsize(part_size)})")
+                part_caption = caption if part_number == 1 else f"🎞 Parte {part_number}/{total_parts}"
+                try:
+                    messages.append(await send_file(message, part_path, part_caption, True, part_meta))
+                finally:
+                    # La parte inviata non serve più: libera subito lo spazio
+                    os.remove(part_path)
+                logging.info(f"Parte {part_number}/{total_parts} inviata in {time.time() - part_start_time:.2f} secondi")
+                split_start = time.monotonic()
 
         total_time = time.time() - start_time
         logging.info(f"File {filepath} inviato con successo in {total_time:.2f} secondi")
-        return True
+        return messages
+    except ItemError as e:
+        logging.error(f"Errore durante l'invio del file grande {filepath}: {e}")
+        raise
     except Exception as e:
         total_time = time.time() - start_time
         logging.error(f"Errore durante l'invio del file grande {filepath} dopo {total_time:.2f} secondi: {e}")
+        return None
+
+def sent_item(message, caption):
+    """Descrive il media contenuto in un messaggio inviato (tipo, file_id, didascalia) per la cache dei file_id."""
+    if message.video:
+        media_type, file_id = "video", message.video.file_id
+    elif message.audio:
+        media_type, file_id = "audio", message.audio.file_id
+    elif message.photo:
+        media_type, file_id = "photo", message.photo[-1].file_id
+    elif message.document:
+        media_type, file_id = "document", message.document.file_id
+    else:
+        return None
+    return {"type": media_type, "file_id": file_id, "caption": caption}
+
+async def send_cached(message: Message, items):
+    """Reinvia elementi già presenti su Telegram tramite file_id, senza download né upload."""
+    chat_id = message.chat.id
+    media_group = []
+    for item in items:
+        if item["type"] == "audio":
+            await outbound.call(chat_id, functools.partial(message.reply_audio, item["file_id"], caption=item["caption"], parse_mode=ParseMode.MARKDOWN))
+        elif item["type"] == "document":
+            await outbound.call(chat_id, functools.partial(message.reply_document, item["file_id"], caption=item["caption"], parse_mode=ParseMode.MARKDOWN))
+        elif item["type"] == "photo":
+            media_group.append(InputMediaPhoto(item["file_id"], caption=item["caption"], parse_mode=ParseMode.MARKDOWN))
+        elif item["type"] == "video":
+            media_group.append(InputMediaVideo(item["file_id"], caption=item["caption"], parse_mode=ParseMode.MARKDOWN))
+    for media_chunk in [media_group[i:i + 10] for i in range(0, len(media_group), 10)]:
+        await outbound.call(chat_id, functools.partial(message.reply_media_group, media=media_chunk), cost=len(media_chunk))
+
+async def send_from_cache(update: Update, context: ContextTypes.DEFAULT_TYPE, ctx: RequestContext):
+    """Prova a soddisfare la richiesta dalla cache dei file_id. Restituisce True se l'invio è riuscito."""
+    key = ctx.cache_key()
+    try:
+        items = await scheduler.run_blocking(file_id_cache.get, key)
+    except Exception as e:
+        logging.error(f"Errore durante la lettura della cache dei file_id: {e}")
         return False
-    finally:
-        # Pulisci tutti i file temporanei alla fine
-        for temp_file in temp_files:
-            try:
-                if os.path.exists(temp_file):
-                    os.unlink(temp_file)
-                    logging.debug(f"File temporaneo eliminato: {temp_file}")
-            except Exception as e:
-                logging.error(f"Errore durante l'eliminazione del file temporaneo {temp_file}: {e}")
+    if not items:
+        return False
+    try:
+        await send_cached(update.message, items)
+    except Exception as e:
+        # file_id non più valido: si procede con il download e la voce verrà sovrascritta
+        logging.warning(f"Invio dalla cache non riuscito per {key}: {e}")
+        await scheduler.run_blocking(file_id_cache.delete, key)
+        return False
+    logging.info(f"Richiesta servita dalla cache dei file_id: {key} ({file_id_cache.stats()})")
+    await react(context.bot, update.message.chat.id, update.message.message_id, "👌")
+    return True
+
+def extract_urls(text):
+    """Tutti i link di un messaggio, nell'ordine in cui compaiono e senza duplicati, anche scritti in forme diverse
+    (al massimo MAX_LINKS_PER_MESSAGE)."""
+    urls = []
+    keys = set()
+    for match in re.finditer(r'https?://\S+', text):
+        url = match.group(0).rstrip(".,;:!?)]>\"'")  # Punteggiatura attaccata al link nel testo
+        if canonical_key(url) not in keys:
+            keys.add(canonical_key(url))
+            urls.append(url)
+    return urls[:MAX_LINKS_PER_MESSAGE]
+
+def payload_urls(payload):
+    """Link di un job; i job accodati prima del supporto ai link multipli ne hanno uno solo."""
+    return payload.get("urls") or [payload["url"]]
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Gestisce i messaggi ricevuti dal bot."""
@@ -338,16 +2555,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
 
-    # Controlla se il messaggio contiene un link
+    # Controlla se il messaggio contiene dei link
     text = update.message.text.strip()
-    link_match = re.search(r'https?://\S+', text)
+    urls = extract_urls(text)
 
-    if link_match:  # Reazione 👍 solo se c'è un link
-        try:
-            await context.bot.set_message_reaction(chat_id, update.message.message_id, "👍")
-            asyncio.create_task(delayed_cleanup_download_dir())
-        except Exception as e:
-            logging.error(f"Errore durante l'aggiunta della reazione 👍: {e}")
+    if urls:  # Reazione 👍 solo se c'è un link
+        await react(context.bot, chat_id, update.message.message_id, "👍")
     else:
         logging.info("Messaggio ricevuto senza link: nessuna reazione 👍")
 
@@ -355,151 +2568,603 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_id not in ALLOWED_IDS and chat_id not in ALLOWED_IDS:
         return
 
-    text = update.message.text.strip()
-    link_match = re.search(r'https?://\S+', text)
-    if not link_match:
+    if not urls:
         return
 
-    url = link_match.group(0)
     is_audio = "audio" in text.lower()
-    logging.info(f"URL ricevuto: {url}")
+    logging.info(f"URL ricevuti: {' '.join(urls)}")
 
+    # Un link già inviato in passato viene reinviato subito tramite file_id, purché la chat non abbia job in attesa
+    # o in corso, che devono rispondere prima; altrimenti (e con più link) la cache viene consultata dal job
+    cache_checked = len(urls) == 1 and not await scheduler.run_blocking(job_queue.chat_busy, chat_id)
+    if cache_checked and await send_from_cache(update, context, RequestContext(urls[0], is_audio)):
+        return
+
+    # Il job viene registrato nella coda persistente: sopravvive a riavvii e crash
+    payload = {"message": update.message.to_dict(), "urls": urls, "is_audio": is_audio, "cache_checked": cache_checked}
+    priority = 1 if is_audio else 0  # Gli audio sono piccoli e veloci: passano davanti ai video
+    job_id = await scheduler.run_blocking(job_queue.enqueue, chat_id, user_id, payload, priority)
+    logging.info(f"Job {job_id} accodato per {len(urls)} link")
+    dispatcher.notify()
+
+async def serve_webhook(app, method, headers, body):
+    """Riceve un update da Telegram e lo passa alla coda degli update dell'applicazione, come il long polling."""
+    if method != "POST":
+        return 405, "text/plain", b"method not allowed\n"
+    if WEBHOOK_SECRET_TOKEN and not secrets.compare_digest(
+        headers.get("x-telegram-bot-api-secret-token", "").encode(), WEBHOOK_SECRET_TOKEN.encode()
+    ):
+        logging.error("Richiesta al webhook con secret token non valido")
+        return 403, "text/plain", b"forbidden\n"
+    if health.stopping:
+        # Durante l'arresto Telegram riprova più tardi: l'update verrà consegnato al riavvio
+        return 503, "text/plain", b"stopping\n"
     try:
-        # Verifica la dimensione del file prima del download
-        cmd = ["yt-dlp", "-J", "--cookies", COOKIES_PATH, url]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if result.returncode == 0:
-            data = json.loads(result.stdout)
-            # Controlla vari campi che potrebbero contenere la dimensione
-            filesize = None
-            if "filesize" in data:
-                filesize = data["filesize"]
-            elif "filesize_approx" in data:
-                filesize = data["filesize_approx"]
-            elif "filesize_pre" in data:
-                filesize = data["filesize_pre"]
-            
-            if filesize and filesize > MAX_FILE_SIZE:
-                await update.message.reply_text(
-                    f"⚠️ Il file è troppo grande ({humanize.naturalsize(filesize)}). "
-                    f"Il limite massimo è {humanize.naturalsize(MAX_FILE_SIZE)}."
-                )
-                await context.bot.set_message_reaction(chat_id, update.message.message_id, "💔")
-                return
+        update = Update.de_json(json.loads(body), app.bot)
+    except Exception as e:
+        logging.error(f"Update non valido ricevuto dal webhook: {e}")
+        return 400, "text/plain", b"bad request\n"
+    await app.update_queue.put(update)
+    return 200, "text/plain", b"ok\n"
 
-        # Scarica il contenuto
-        downloaded_files = await download_content(url, is_audio)
-        if not downloaded_files:
-            await context.bot.set_message_reaction(chat_id, update.message.message_id, "💔")
-            asyncio.create_task(delayed_cleanup_download_dir())
-            return
+class ProgressReporter:
+    """Messaggio di stato unico, modificato al massimo ogni PROGRESS_EDIT_INTERVAL secondi per rispettare i limiti di Telegram."""
 
-        # Verifica la dimensione dei file scaricati
-        for filepath in downloaded_files:
-            if os.path.getsize(filepath) > MAX_FILE_SIZE:
-                await update.message.reply_text(
-                    f"⚠️ Il file scaricato è troppo grande ({humanize.naturalsize(os.path.getsize(filepath))}). "
-                    f"Il limite massimo è {humanize.naturalsize(MAX_FILE_SIZE)}."
-                )
-                await context.bot.set_message_reaction(chat_id, update.message.message_id, "💔")
-                try:
-                    os.remove(filepath)
-                    logging.info(f"File troppo grande eliminato: {filepath}")
-                except Exception as e:
-                    logging.error(f"Errore durante l'eliminazione del file troppo grande {filepath}: {e}")
-                return
+    def __init__(self, message: Message):
+        self.source = message  # messaggio dell'utente a cui rispondere
+        self.message = None
+        self.last_text = None
+        self.last_edit = 0.0
+        self.started = time.monotonic()
 
-        # Prepara e invia i file
-        media_group = []
-        username = f"@{update.message.from_user.username}" if update.message.from_user.username else "utente"
+    async def show(self, text):
+        now = time.monotonic()
+        # Nessun messaggio di stato per i download rapidi, e modifiche distanziate nel tempo
+        if now - self.started < PROGRESS_EDIT_INTERVAL or now - self.last_edit < PROGRESS_EDIT_INTERVAL:
+            return
+        if text == self.last_text:
+            return
+        self.last_edit = now
+        try:
+            if self.message is None:
+                self.message = await outbound.call(self.source.chat.id, functools.partial(self.source.reply_text, text))
+            else:
+                await outbound.call(self.source.chat.id, functools.partial(self.message.edit_text, text))
+            self.last_text = text
+        except Exception as e:
+            logging.warning(f"Errore durante l'aggiornamento del messaggio di stato: {e}")
 
-        for filepath in downloaded_files:
+    async def report(self, progress, label=None):
+        """Aggiorna il messaggio di stato con l'avanzamento riportato da yt-dlp, preceduto dall'elemento a cui si riferisce."""
+        downloaded, total, speed = progress["downloaded"], progress["total"], progress["speed"]
+        if downloaded is None:
+            return
+        if total:
+            text = f"⏬ {downloaded / total:.0%} · {humanize.naturalsize(downloaded)} / {humanize.naturalsize(total)}"
+        else:
+            text = f"⏬ {humanize.naturalsize(downloaded)}"
+        if speed:
+            text += f" · {humanize.naturalsize(speed)}/s"
+        if label:
+            text = f"{label} {text}"
+        await self.show(text)
+
+    async def finish(self):
+        """Elimina il messaggio di stato a fine job."""
+        if self.message is not None:
             try:
-                size_bytes = os.path.getsize(filepath)
-                size_human = humanize.naturalsize(size_bytes)
-                file_extension = os.path.splitext(filepath)[1].lower()
-
-                if is_audio and file_extension == '.mp3':
-                    # Invia solo il file audio se "audio" è specificato
-                    caption = f"🔗 [Link]({url})"
-                    await update.message.reply_audio(open(filepath, "rb"), caption=caption, parse_mode="Markdown")
-                    
-                    # Cancella il file MP3 dopo l'invio
-                    try:
-                        os.remove(filepath)
-                        logging.info(f"File audio eliminato: {filepath}")
-                    except Exception as e:
-                        logging.error(f"Errore durante l'eliminazione del file audio {filepath}: {e}")
-                    
-                    return  # Esci dopo aver inviato l'audio
-                elif not is_audio:
-                    if file_extension in ['.jpg', '.jpeg', '.png']:
-                        caption = f"🔗 [Link]({url})"
-                        media_group.append(InputMediaPhoto(open(filepath, "rb"), caption=caption, parse_mode=ParseMode.MARKDOWN))
-                    elif file_extension in ['.mp4', '.webm']:
-                        description, duration, uploader, uploader_url, extractor, like_count_formatted = get_video_details(url, COOKIES_PATH)
-                        uploader_hyperlink = f"[{uploader}]({uploader_url})" if uploader_url else uploader
-                        caption = (
-                            f"🔗 [Link {extractor}]({url})\n"
-                            f"👤 {uploader_hyperlink}\n"
-                            f"🕒 *{duration}* | 👍 *{like_count_formatted}*\n"
-                            f"📝 {description}\n"
-                        )
-                        media_group.append(InputMediaVideo(open(filepath, "rb"), caption=caption, parse_mode=ParseMode.MARKDOWN))
-                    else:
-                        logging.warning(f"Tipo di file non supportato: {filepath}")
+                await outbound.call(self.source.chat.id, self.message.delete)
             except Exception as e:
-                logging.error(f"Errore durante la preparazione del file {filepath}: {e}")
+                logging.warning(f"Errore durante l'eliminazione del messaggio di stato: {e}")
+            self.message = None
+
+class ItemError(Exception):
+    """Errore di un singolo elemento della richiesta, con un messaggio da mostrare all'utente."""
+
+class UploadPipeline:
+    """Invia i file di una richiesta man mano che il download li produce, nell'ordine dei suoi elementi.
+
+    Foto e video vengono raccolti in media group da 10, anche tra elementi diversi, e inviati appena il gruppo è completo;
+    audio e video oltre il limite vengono inviati subito, mentre il download dei successivi prosegue.
+    Un errore esclude solo l'elemento a cui appartiene il file; ogni elemento viene chiuso appena inviato.
+    """
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.queue = asyncio.Queue()
+        self.media_group = []  # (elemento, tipo di InputMedia, percorso, file_id, didascalia)
+        self.sent_items = {}  # elemento -> file_id restituiti da Telegram, salvati per i reinvii futuri
+        self.failed = {}  # elemento -> errore
+        self.cached = set()  # elementi reinviati dalla cache dei file_id
+        self.finished = []  # elementi scaricati, chiusi quando tutti i loro file sono stati inviati
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
 
-        # Invia i file multimediali (immagini e video) solo se "audio" non è specificato
-        if not is_audio and media_group:
-            for media_chunk in [media_group[i:i + 10] for i in range(0, len(media_group), 10)]:
+    async def put(self, event):
+        """Accoda un evento di un elemento: ("file", ctx, percorso), ("cached", ctx, elementi),
+        ("stream", ctx, (esito, avanzamento)) o ("end", ctx, errore)."""
+        await self.queue.put(event)
+
+    async def close(self):
+        """Attende l'invio di tutti i file in coda e dell'ultimo media group."""
+        if self.task is None or self.task.done():
+            return
+        await self.queue.put(None)
+        await self.task
+
+    async def cancel(self):
+        """Interrompe gli invii senza inviare i file in coda né l'ultimo media group (arresto o lease perso)."""
+        if self.task is None or self.task.done():
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            event = await self.queue.get()
+            if event is None:
+                break
+            kind, ctx, value = event
+            if kind == "stream":
+                await self._stream(ctx, *value)
+            elif kind == "end":
+                if value is not None:
+                    self.failed.setdefault(ctx, value)
+                self.finished.append(ctx)
+            elif ctx not in self.failed:  # Dopo un errore i file rimanenti dell'elemento vengono solo scartati
                 try:
-                    await update.message.reply_media_group(media=media_chunk)
+                    if kind == "cached":
+                        await self._send_cached(ctx, value)
+                    else:
+                        await self._send(ctx, value)
                 except Exception as e:
-                    logging.error(f"Errore durante l'invio del gruppo di media: {e}")
-                    await context.bot.set_message_reaction(chat_id, update.message.message_id, "💔")
-                    return
+                    logging.error(f"Errore durante l'invio di {ctx.url}: {e}")
+                    self.failed[ctx] = e
+            await self._release()
+        await self._flush()
+        await self._release()
+
+    async def _release(self):
+        """Chiude gli elementi conclusi i cui file sono stati tutti inviati: salva i file_id ed elimina la cartella."""
+        pending = {entry[0] for entry in self.media_group}
+        for ctx in [ctx for ctx in self.finished if ctx not in pending]:
+            self.finished.remove(ctx)
+            sent_items = [item for item in self.sent_items.get(ctx, []) if item]
+            if ctx not in self.failed and sent_items:
+                await scheduler.run_blocking(file_id_cache.put, ctx.cache_key(), sent_items)
+            if ctx not in self.failed and ctx.job_id is not None:
+                await scheduler.run_blocking(job_queue.mark_sent, ctx.job_id, ctx.item)
+            await scheduler.run_blocking(ctx.close)
+
+    def _sent(self, ctx, message, caption):
+        self.sent_items.setdefault(ctx, []).append(sent_item(message, caption))
+
+    async def _send_cached(self, ctx, items):
+        """Reinvia un elemento tramite i file_id in cache, mantenendo foto e video nel media group in corso."""
+        self.cached.add(ctx)
+        for item in items:
+            if item["type"] in ("photo", "video"):
+                media_type = InputMediaPhoto if item["type"] == "photo" else InputMediaVideo
+                self.media_group.append((ctx, media_type, None, item["file_id"], item["caption"]))
+                if len(self.media_group) >= 10:
+                    await self._flush()
+                continue
+            await self._flush()  # Rispetta l'ordine rispetto ai media già raccolti
+            reply = self.message.reply_audio if item["type"] == "audio" else self.message.reply_document
+            await outbound.call(self.message.chat.id, functools.partial(reply, item["file_id"], caption=item["caption"], parse_mode=ParseMode.MARKDOWN))
+
+    async def _stream(self, ctx, result, on_progress):
+        """Invia un elemento direttamente dall'output di yt-dlp; `result` riceve gli elementi inviati, o None se serve il download su disco."""
+        await self._flush()
+        caption = build_video_caption(ctx.info, ctx.url)
+        try:
+            message = await outbound.call(
+                self.message.chat.id, functools.partial(stream_video, self.message, ctx, caption, on_progress), PRIORITY_UPLOAD
+            )
+        except Exception as e:
+            logging.warning(f"Invio in streaming non riuscito per {ctx.url}, si ripiega sul download su disco: {e}")
+            result.set_result(None)
+            return
+        self._sent(ctx, message, caption)
+        result.set_result(list(self.sent_items[ctx]))
+
+    async def _send(self, ctx, filepath):
+        url = ctx.url
+        size_bytes = await scheduler.run_blocking(os.path.getsize, filepath)
+        file_extension = os.path.splitext(filepath)[1].lower()
+        is_video = file_extension in VIDEO_EXTENSIONS
+
+        if size_bytes > MAX_FILE_SIZE:
+            if SPLIT_LARGE_VIDEOS and not ctx.is_audio and is_video:
+                # Video oltre il limite: diviso in parti riproducibili e caricato man mano
+                await self._flush()
+                info = ctx.entry_info(filepath)
+                meta = {"duration": info.get("duration") if info else None, **ctx.media_info.get(filepath, {})}
+                messages = await send_large_file(self.message, filepath, build_video_caption(info, url), is_video=True, meta=meta)
+                if messages is None:
+                    raise Exception("invio in parti non riuscito")
+                for message in messages:
+                    self._sent(ctx, message, message.caption_markdown if message.caption else None)
+                return
+            raise ItemError(
+                f"⚠️ Il file scaricato è troppo grande ({humanize.naturalsize(size_bytes)}). "
+                f"Il limite massimo è {humanize.naturalsize(MAX_FILE_SIZE)}."
+            )
+
+        if ctx.is_audio:
+            # Invia solo il file audio se "audio" è specificato: MP3 e M4A come audio, il resto come documento
+            caption = f"🔗 [Link]({url})"
+            if file_extension in AUDIO_EXTENSIONS:
+                await self._flush()
+
+                async def upload():
+                    with contextlib.ExitStack() as stack:
+                        audio_file = media_input(filepath, stack)
+                        return await self.message.reply_audio(audio_file, caption=caption, parse_mode="Markdown")
+                message = await outbound.call(self.message.chat.id, upload, PRIORITY_UPLOAD)
+                metrics.inc("yatytb_uploaded_bytes_total", size_bytes)
+            elif file_extension in OTHER_AUDIO_EXTENSIONS:
+                await self._flush()
+                message = await send_file(self.message, filepath, caption, is_video=False)
+            else:
+                return
+            self._sent(ctx, message, caption)
+            return
+
+        if file_extension in PHOTO_EXTENSIONS:
+            caption = f"🔗 [Link]({url})"
+            self.media_group.append((ctx, InputMediaPhoto, filepath, None, caption))
+        elif file_extension in ['.mp4', '.webm']:
+            caption = build_video_caption(ctx.entry_info(filepath), url)
+            self.media_group.append((ctx, InputMediaVideo, filepath, None, caption))
+        else:
+            logging.warning(f"Tipo di file non supportato: {filepath}")
+        if len(self.media_group) >= 10:
+            await self._flush()
+
+    async def _flush(self):
+        """Invia il media group in attesa, aprendo i file solo per la durata dell'invio.
+
+        Se l'invio non riesce, tutti gli elementi presenti nel gruppo vengono segnati come non inviati.
+        """
+        if not self.media_group:
+            return
+        media_chunk, self.media_group = self.media_group, []
+
+        async def upload():
+            # Ricostruito a ogni tentativo: i file vanno riaperti da capo
+            with contextlib.ExitStack() as stack:
+                media = []
+                for ctx, media_type, filepath, file_id, caption in media_chunk:
+                    params = {}
+                    if media_type is InputMediaVideo and not file_id:
+                        # Dimensioni e miniatura evitano l'anteprima quadrata e lo scaricamento completo prima della riproduzione
+                        params = {"supports_streaming": True, **video_params(ctx.media_info.get(filepath, {}), stack)}
+                    media.append(media_type(
+                        file_id or media_input(filepath, stack), caption=caption, parse_mode=ParseMode.MARKDOWN, **params
+                    ))
+                return await self.message.reply_media_group(
+                    media=media,
+                    read_timeout=UPLOAD_TIMEOUT,
+                    write_timeout=UPLOAD_TIMEOUT,
+                    connect_timeout=UPLOAD_TIMEOUT,
+                    pool_timeout=UPLOAD_TIMEOUT
+                )
+        try:
+            messages = await outbound.call(self.message.chat.id, upload, PRIORITY_UPLOAD, cost=len(media_chunk))
+        except Exception as e:
+            logging.error(f"Errore durante l'invio del gruppo di media: {e}")
+            for ctx in {entry[0] for entry in media_chunk}:
+                self.failed.setdefault(ctx, e)
+                if ctx in self.cached:
+                    # file_id non più valido: la voce verrà sostituita al prossimo download
+                    await scheduler.run_blocking(file_id_cache.delete, ctx.cache_key())
+            return
+        for (ctx, _, filepath, file_id, caption), message in zip(media_chunk, messages):
+            if not file_id:
+                metrics.inc("yatytb_uploaded_bytes_total", os.path.getsize(filepath))
+                self._sent(ctx, message, caption)
+
+async def expand_items(contexts):
+    """Restituisce gli elementi della richiesta in ordine: i link e, al posto di ogni playlist, le sue voci.
+
+    I metadati dei link vengono estratti in parallelo (al massimo MAX_PARALLEL_ITEMS alla volta);
+    delle playlist si leggono solo le prime PLAYLIST_MAX_ITEMS voci, senza risolverle.
+    """
+    slots = asyncio.Semaphore(MAX_PARALLEL_ITEMS)
+
+    async def probe(ctx):
+        if "instagram.com/p/" in ctx.url:
+            return  # I post di Instagram vengono scaricati con gallery-dl, senza metadati
+        async with slots:
+            await ctx.probe()
+
+    probes = [asyncio.create_task(probe(ctx)) for ctx in contexts]
+    try:
+        for ctx, task in zip(contexts, probes):
+            await task
+            if not ctx.is_playlist:
+                yield ctx
+                continue
+            entries = [entry for entry in ctx.info.get("entries") or [] if entry][:PLAYLIST_MAX_ITEMS]
+            logging.info(f"Playlist {ctx.url}: {len(entries)} elementi")
+            for entry in entries:
+                url = entry.get("webpage_url") or entry.get("url")
+                if url:
+                    yield RequestContext(url, ctx.is_audio, job_id=ctx.job_id)
+    finally:
+        for task in probes:
+            task.cancel()
+        await asyncio.gather(*probes, return_exceptions=True)
+
+async def fetch_item(ctx: RequestContext, outbox: asyncio.Queue, progress: ProgressReporter, label=None, stream=False):
+    """Scarica un elemento della richiesta, passando a outbox i suoi file appena sono pronti e infine l'esito.
+
+    Con `stream` (richieste di un solo elemento, che non finisce in un media group) un formato che non richiede merge
+    viene inviato direttamente dall'output di yt-dlp, senza passare dal disco. Se lo stesso contenuto è già in download
+    per un'altra richiesta, l'elemento ne attende l'esito e ne riusa i file o i file_id.
+    """
+    error = None
+
+    async def on_progress(status):
+        await progress.report(status, label)
+
+    caption_probed = False
+
+    async def emit(filepath):
+        nonlocal caption_probed
+        is_video = not ctx.is_audio and os.path.splitext(filepath)[1].lower() in VIDEO_EXTENSIONS
+        # I post di Instagram non passano dal probe iniziale: i metadati per la didascalia si estraggono
+        # una sola volta, e solo se il post contiene un video
+        if is_video and "instagram.com/p/" in ctx.url and ctx.info is None and not caption_probed:
+            caption_probed = True
+            await ctx.probe()
+        # I video vengono preparati per Telegram (faststart, dimensioni, miniatura) in parallelo tra gli elementi
+        if PREPARE_VIDEOS and is_video:
+            ctx.media_info[filepath] = await prepare_video(filepath)
+        await outbox.put(("file", ctx, filepath))
+
+    async def adopt(result):
+        # Riusa l'esito del download già in corso per lo stesso contenuto; False se non è più utilizzabile
+        if result[0] == "cached":
+            await outbox.put(("cached", ctx, result[1]))
+            return True
+        _, ctx.info, files = result
+        workspace = await scheduler.run_blocking(ctx.create_workspace)
+        linked = await scheduler.run_blocking(inflight.link, files, workspace)
+        if linked is None:
+            # L'altro elemento ha già inviato ed eliminato i suoi file: i file_id sono già in cache
+            items = await scheduler.run_blocking(file_id_cache.get, ctx.cache_key(), record=False)
+            if not items:
+                return False
+            await outbox.put(("cached", ctx, items))
+            return True
+        for entry_id, filepath in linked:
+            ctx.file_ids[filepath] = entry_id
+            ctx.files.append(filepath)
+            await emit(filepath)
+        return True
+
+    try:
+        # Gli elementi già inviati in passato vengono reinviati tramite file_id
+        # (l'elemento viene contato una sola volta, anche se la cache è già stata consultata alla ricezione)
+        items = await scheduler.run_blocking(file_id_cache.get, ctx.cache_key(), record=not ctx.cache_checked)
+        if items:
+            logging.info(f"Elemento servito dalla cache dei file_id: {ctx.cache_key()}")
+            await outbox.put(("cached", ctx, items))
+            await outbox.put(("end", ctx, None))
+            return
+
+        # Lo stesso contenuto è già in download per un'altra richiesta: se ne attende l'esito invece di scaricarlo di nuovo.
+        # Se quel download non riesce, l'elemento prova da sé (o si unisce a un nuovo download nel frattempo avviato)
+        while (leader := inflight.join(ctx)) is not None:
+            logging.info(f"Elemento unito a un download già in corso: {ctx.cache_key()}")
+            result = await asyncio.shield(leader)  # L'annullamento di questo elemento non tocca l'altro
+            if result and await adopt(result):
+                await outbox.put(("end", ctx, None))
+                return
 
-        # Cancella tutti i file dopo l'invio
-        for filepath in downloaded_files:
+        # Estrae i metadati una sola volta e verifica la dimensione del file prima del download
+        if "instagram.com/p/" not in ctx.url:
+            await ctx.probe()
+            if ctx.is_playlist:
+                raise ItemError("⚠️ Playlist annidata: invia direttamente il suo link")
+            # Sceglie in anticipo un formato che rientri nel limite, per non scaricare file che non si possono inviare
+            size_limit = MAX_FILE_SIZE
+            if not ctx.is_audio:
+                ctx.plan_format(MAX_FILE_SIZE)
+                if ctx.format_spec is None and SPLIT_LARGE_VIDEOS and ctx.estimated_size and ctx.estimated_size > MAX_FILE_SIZE:
+                    # Nessun formato rientra nel limite: si scarica il video intero e lo si invia in parti
+                    size_limit = MAX_SPLIT_FILE_SIZE
+                    ctx.plan_format(MAX_SPLIT_FILE_SIZE)
+            else:
+                ctx.plan_audio_format(MAX_FILE_SIZE)
+            filesize = ctx.estimated_size
+            if ctx.format_spec is None and filesize and filesize > size_limit:
+                raise ItemError(
+                    f"⚠️ Il file è troppo grande ({humanize.naturalsize(filesize)}). "
+                    f"Il limite massimo è {humanize.naturalsize(size_limit)}."
+                )
+
+        # Lo stesso contenuto nello stesso formato, già scaricato per un'altra richiesta, viene preso dalla cache su disco
+        media_key = ctx.media_key()
+        if media_key and media_cache.enabled:
+            workspace = await scheduler.run_blocking(ctx.create_workspace)
+            cached_files = await scheduler.run_blocking(media_cache.get, media_key, workspace)
+            if cached_files:
+                logging.info(f"Elemento servito dalla cache su disco: {media_key} ({media_cache.stats()})")
+                for entry_id, filepath in cached_files:
+                    ctx.file_ids[filepath] = entry_id
+                    ctx.files.append(filepath)
+                    await emit(filepath)
+                inflight.resolve(ctx, ("files", ctx.info, cached_files))
+                await outbox.put(("end", ctx, None))
+                return
+
+        if stream and ctx.streamable():
+            result = asyncio.get_running_loop().create_future()
+            await outbox.put(("stream", ctx, (result, on_progress)))
+            sent = await result
+            if sent is not None:
+                items = [item for item in sent if item]
+                inflight.resolve(ctx, ("cached", items) if items else None)
+                await outbox.put(("end", ctx, None))
+                return
+
+        files = await download_content(ctx, on_file=emit, on_progress=on_progress)
+        if not files:
+            raise Exception("download non riuscito")
+        inflight.resolve(ctx, ("files", ctx.info, [(ctx.file_ids.get(path), path) for path in files]))
+        if media_key:
             try:
-                os.remove(filepath)
-                logging.info(f"File eliminato: {filepath}")
+                await scheduler.run_blocking(media_cache.put, media_key, [(ctx.file_ids.get(path), path) for path in files])
             except Exception as e:
-                logging.error(f"Errore durante l'eliminazione del file {filepath}: {e}")
-
-        await context.bot.set_message_reaction(chat_id, update.message.message_id, "👌")
-        # Avvia la cancellazione ritardata della cartella downloads
-        asyncio.create_task(delayed_cleanup_download_dir())
+                logging.error(f"Errore durante il salvataggio nella cache su disco: {e}")
     except Exception as e:
-        logging.error(f"Errore durante la gestione del messaggio: {e}")
-        await context.bot.set_message_reaction(chat_id, update.message.message_id, "💔")
-        asyncio.create_task(delayed_cleanup_download_dir())
+        logging.error(f"Errore durante l'elaborazione di {ctx.url}: {e}")
+        error = e
+    finally:
+        inflight.resolve(ctx, None)  # Download non riuscito o annullato: gli elementi in attesa procedono da sé
+    await outbox.put(("end", ctx, error))
+
+async def report_failures(message: Message, items, failures):
+    """Riepiloga gli elementi non inviati. Con un solo elemento viene mostrato solo un errore destinato all'utente."""
+    if len(items) == 1:
+        error = failures[0][1]
+        if not isinstance(error, ItemError):
+            return
+        text = str(error)
+    else:
+        lines = [f"⚠️ {len(failures)} elementi su {len(items)} non inviati:"]
+        lines += [f"{ctx.item + 1}. {ctx.url} — {error}" for ctx, error in failures]
+        text = "\n".join(lines)[:4096]  # Lunghezza massima di un messaggio Telegram
+    await outbound.call(message.chat.id, functools.partial(message.reply_text, text, disable_web_page_preview=True))
+
+async def process_request(message: Message, bot, contexts, delivered=()):
+    """Scarica e invia i link di una richiesta, nell'ordine del messaggio.
+
+    Gli elementi (link e voci delle playlist) vengono scaricati in parallelo, al massimo MAX_PARALLEL_ITEMS alla volta,
+    e ognuno viene caricato mentre il suo download è ancora in corso. Gli errori dei singoli elementi vengono
+    riepilogati in un messaggio. Gli elementi in `delivered` (posizioni già consegnate da un'esecuzione interrotta
+    dello stesso job) vengono saltati. Restituisce True se almeno un elemento è stato inviato.
+    """
+    chat_id = message.chat.id
+    job_id = contexts[0].job_id
+    # Tempi per fase del job, raccolti anche dai task degli elementi e dalla pipeline di upload
+    spans = Counter()
+    job_spans.set(spans)
+    job_start = time.monotonic()
+    metrics.stage("queue_wait", max(0.0, time.time() - message.date.timestamp()))
+    progress = ProgressReporter(message)
+    pipeline = UploadPipeline(message)
+    slots = asyncio.Semaphore(MAX_PARALLEL_ITEMS)
+    ordered = asyncio.Queue()  # (elemento, coda dei suoi file) nell'ordine della richiesta
+    items = []
+    tasks = []
+    forwarder = None
+    interrupted = False
+
+    async def run_item(ctx, outbox, label, stream):
+        try:
+            await fetch_item(ctx, outbox, progress, label, stream)
+        finally:
+            slots.release()
+
+    async def forward():
+        # Passa alla pipeline i file degli elementi nell'ordine della richiesta, man mano che vengono prodotti
+        while (entry := await ordered.get()) is not None:
+            _, outbox = entry
+            while True:
+                event = await outbox.get()
+                await pipeline.put(event)
+                if event[0] == "end":
+                    break
 
-async def delayed_cleanup_download_dir(delay_seconds=10):
-    """Attende delay_seconds e poi elimina tutti i file nella cartella DOWNLOAD_DIR, lasciando la cartella intatta."""
-    await asyncio.sleep(delay_seconds)
     try:
-        if os.path.exists(DOWNLOAD_DIR):
-            for filename in os.listdir(DOWNLOAD_DIR):
-                file_path = os.path.join(DOWNLOAD_DIR, filename)
-                try:
-                    if os.path.isfile(file_path) or os.path.islink(file_path):
-                        os.remove(file_path)
-                        logging.info(f"File eliminato: {file_path}")
-                    elif os.path.isdir(file_path):
-                        shutil.rmtree(file_path)
-                        logging.info(f"Cartella eliminata: {file_path}")
-                except Exception as e:
-                    logging.error(f"Errore durante l'eliminazione di {file_path}: {e}")
+        await contexts[0].set_state(JOB_DOWNLOADING)
+        pipeline.start()
+        forwarder = asyncio.create_task(forward())
+        try:
+            async with contextlib.aclosing(expand_items(contexts)) as expanded:
+                async for ctx in expanded:
+                    ctx.item = len(items)
+                    items.append(ctx)
+                    if ctx.item in delivered:
+                        logging.info(f"Elemento {ctx.item + 1} del job {job_id} già consegnato prima dell'interruzione")
+                        continue
+                    await slots.acquire()
+                    multiple = len(contexts) > 1 or contexts[0].is_playlist
+                    outbox = asyncio.Queue()
+                    tasks.append(asyncio.create_task(run_item(ctx, outbox, f"[{ctx.item + 1}]" if multiple else None, not multiple)))
+                    await ordered.put((ctx, outbox))
+            await asyncio.gather(*tasks)
+        finally:
+            await ordered.put(None)
+        await forwarder
+        await contexts[0].set_state(JOB_UPLOADING)
+        await pipeline.close()
+
+        failures = [(ctx, pipeline.failed[ctx]) for ctx in items if ctx in pipeline.failed]
+        for ctx in items:
+            metrics.inc("yatytb_items_total", extractor=ctx.extractor, result="failed" if ctx in pipeline.failed else "sent")
+        if failures:
+            await report_failures(message, items, failures)
+        sent = len(items) - len(failures)
+        metrics.inc("yatytb_jobs_total", result="done" if sent else "failed")
+        if len(items) > 1:
+            logging.info(f"Richiesta completata: {sent}/{len(items)} elementi inviati")
+        await react(bot, chat_id, message.message_id, "👌" if sent else "💔")
+        return sent > 0
+    except asyncio.CancelledError:
+        # Arresto del bot o lease perso: i file restano su disco per la ripresa del job
+        interrupted = True
+        raise
     except Exception as e:
-        logging.error(f"Errore durante la pulizia della cartella {DOWNLOAD_DIR}: {e}")
+        logging.error(f"Errore durante la gestione del messaggio: {e}")
+        metrics.inc("yatytb_jobs_total", result="failed")
+        await react(bot, chat_id, message.message_id, "💔")
+        return False
+    finally:
+        pending = [task for task in tasks + [forwarder] if task and not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if interrupted:
+            # Nessun invio dopo l'annullamento: il job viene ripreso al riavvio o da un altro worker,
+            # e i file già in coda verrebbero inviati due volte
+            await pipeline.cancel()
+        else:
+            await pipeline.close()
+            await progress.finish()
+        metrics.stage("total", time.monotonic() - job_start)
+        # Riepilogo strutturato: le fasi degli elementi in parallelo si sommano, "total" è il tempo reale
+        logging.info(f"Tempi del job {job_id}: " + " ".join(
+            f"{stage}={spans[stage]:.2f}s" for stage in ("queue_wait", "probe", "download", "postprocess", "upload", "total")
+        ) + f" elementi={len(items)}")
+        if not interrupted:
+            # Elimina solo i file di questo job, senza toccare i download degli altri
+            for ctx in items + contexts:
+                await scheduler.run_blocking(ctx.close)
+            if job_id is not None:
+                await scheduler.run_blocking(shutil.rmtree, os.path.join(DOWNLOAD_DIR, f"job-{job_id}"), True)
 
 if __name__ == "__main__":
     if not TOKEN or not ALLOWED_IDS:
         logging.error("TOKEN o ALLOWED_IDS non configurati correttamente")
         exit(1)
+    if BOT_ROLE not in ("all", "ingress", "worker"):
+        logging.error(f"BOT_ROLE non valido: {BOT_ROLE} (valori ammessi: all, ingress, worker)")
+        exit(1)
+    if bool(WEBHOOK_TLS_CERT) != bool(WEBHOOK_TLS_KEY):
+        # Con uno solo dei due il server parlerebbe HTTP in chiaro senza avvisare
+        logging.error("WEBHOOK_TLS_CERT e WEBHOOK_TLS_KEY vanno configurati insieme")
+        exit(1)
+    if BOT_API_LOCAL_MODE and not BOT_API_BASE_URL:
+        # L'API pubblica non accetta percorsi locali né file oltre i 50 MB
+        logging.error("BOT_API_LOCAL_MODE richiede BOT_API_BASE_URL (server Bot API avviato con --local)")
+        exit(1)
 
     # Messaggio di avvio
     logging.info("""
@@ -517,30 +3182,106 @@ if __name__ == "__main__":
     def signal_handler():
         """Gestisce il segnale di arresto."""
         logging.info("Segnale di arresto ricevuto")
+        health.stopping = True  # /readyz risponde subito 503, prima ancora che inizi lo svuotamento
         stop_flag.set()
 
     async def main():
-        # Pulisci la cartella downloads all'avvio
-        await cleanup_download_dir()
+        receives_updates = BOT_ROLE in ("all", "ingress")
+        runs_jobs = BOT_ROLE in ("all", "worker")
+        logging.info(f"Ruolo del processo: {BOT_ROLE} (worker {WORKER_ID})")
+
+        abandoned = []
+        if runs_jobs:
+            # Rimette in coda i job interrotti dall'ultimo arresto e pulisce la cartella downloads,
+            # conservando le cartelle dei job da riprendere. Con più worker vengono ripresi solo i job
+            # con il lease scaduto: gli altri appartengono a worker ancora attivi
+            abandoned = job_queue.recover(MAX_JOB_ATTEMPTS, expired_only=BOT_ROLE == "worker", owner=WORKER_ID)
+            unfinished = job_queue.unfinished_ids()
+            if unfinished:
+                logging.info(f"{len(unfinished)} job da riprendere: {sorted(unfinished)}")
+            await cleanup_download_dir(keep={f"job-{job_id}" for job_id in unfinished})
+            # Applica la quota della cache su disco, che potrebbe essere cambiata dall'ultimo avvio
+            await scheduler.run_blocking(media_cache.evict)
+
+            # Avvia i processi del motore in-process, se richiesto
+            if DOWNLOAD_ENGINE == "inprocess":
+                await engine.start()
+
+        # Endpoint delle metriche per Prometheus e delle sonde di salute
+        if METRICS_PORT:
+            await status_server.start()
         
         # Inizializza il bot
-        app = ApplicationBuilder().token(TOKEN).read_timeout(300).write_timeout(300).build()
-        app.add_handler(MessageHandler(filters.ALL, handle_message))
+        builder = (
+            ApplicationBuilder()
+            .token(TOKEN)
+            .read_timeout(300)
+            .write_timeout(300)
+            .concurrent_updates(CONCURRENT_UPDATES)
+        )
+        if WEBHOOK_URL or not receives_updates:
+            # Gli update arrivano dal server HTTP del webhook, o li riceve il processo ingress: il long polling non serve
+            builder = builder.updater(None)
+        if BOT_API_BASE_URL:
+            # Server Bot API self-hosted (o un sostituto locale per i test)
+            builder = builder.base_url(BOT_API_BASE_URL)
+            if BOT_API_FILE_URL:
+                builder = builder.base_file_url(BOT_API_FILE_URL)
+            builder = builder.local_mode(BOT_API_LOCAL_MODE)
+            logging.info(f"Utilizzo del server Bot API {BOT_API_BASE_URL} (local mode: {BOT_API_LOCAL_MODE})")
+        app = builder.build()
+        if receives_updates:
+            app.add_handler(MessageHandler(filters.ALL, handle_message))
         
         # Avvia il bot
         await app.initialize()
         await app.start()
-        await app.updater.start_polling()
+
+        await report_abandoned(app.bot, abandoned)
+
+        if runs_jobs:
+            dispatcher.start(app.bot)
+        webhook_server = None
+        if not receives_updates:
+            logging.info(f"In attesa di job dalla coda condivisa {JOB_QUEUE_PATH}")
+        elif WEBHOOK_URL:
+            if METRICS_PORT and METRICS_PORT == WEBHOOK_PORT:
+                # Stessa porta delle metriche: un solo server con tutti gli endpoint
+                webhook_server = status_server
+            else:
+                ssl_context = None
+                if WEBHOOK_TLS_CERT and WEBHOOK_TLS_KEY:
+                    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+                    ssl_context.load_cert_chain(WEBHOOK_TLS_CERT, WEBHOOK_TLS_KEY)
+                webhook_server = StatusServer(WEBHOOK_LISTEN, WEBHOOK_PORT, ssl_context)
+            webhook_server.routes[WEBHOOK_PATH] = functools.partial(serve_webhook, app)
+            if webhook_server is not status_server:
+                await webhook_server.start()
+            await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN, max_connections=WEBHOOK_MAX_CONNECTIONS)
+            logging.info(f"Webhook registrato su {WEBHOOK_URL} (percorso locale {WEBHOOK_PATH})")
+        else:
+            await app.updater.start_polling()
+        health.ready = True
         
         try:
             # Attendi il segnale di arresto
             while not stop_flag.is_set():
                 await asyncio.sleep(1)
         finally:
-            # Ferma il bot
-            await app.updater.stop()
+            # Smette di ricevere update, poi attende i job in corso entro la scadenza.
+            # Il webhook resta registrato: Telegram conserva gli update finché il bot non torna disponibile
+            health.stopping = True
+            if webhook_server is not None and webhook_server is not status_server:
+                await webhook_server.stop()
+            if app.updater is not None:
+                await app.updater.stop()
+            await dispatcher.drain(SHUTDOWN_DRAIN_TIMEOUT)
             await app.stop()
             await app.shutdown()
+            scheduler.shutdown()
+            engine.shutdown()
+            outbound.shutdown()
+            await status_server.stop()
 
     # Configura i gestori dei segnali
     loop = asyncio.new_event_loop()
@@ -0,0 +1,12 @@
+# Configurazione del bot per i test, prima dell'import di bot.py
+import os
+import sys
+import tempfile
+
+DATA_DIR = tempfile.mkdtemp(prefix="yatytb-test-")
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("ALLOWED_IDS", "1")
+os.environ["DATA_DIR"] = os.path.join(DATA_DIR, "data")
+os.environ["DOWNLOAD_DIR"] = os.path.join(DATA_DIR, "downloads")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
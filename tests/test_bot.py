@@ -0,0 +1,291 @@
+import asyncio
+import datetime
+import json
+import os
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+import bot
+
+def fake_message(chat_id=1, message_id=1):
+    return SimpleNamespace(
+        chat=SimpleNamespace(id=chat_id, type="private"),
+        message_id=message_id,
+        date=datetime.datetime.now(datetime.timezone.utc),
+        reply_media_group=mock.AsyncMock(),
+        reply_text=mock.AsyncMock(),
+    )
+
+def test_cancelled_job_sends_nothing_queued(tmp_path, monkeypatch):
+    """Un job annullato (arresto o lease perso) non invia il media group in attesa né i file in coda."""
+    queued = asyncio.Event()
+
+    async def fetch_item(ctx, outbox, progress, label=None, stream=False):
+        ctx.workspace = str(tmp_path)
+        for i in range(3):
+            filepath = tmp_path / f"{i}.jpg"
+            filepath.write_bytes(b"jpg")
+            await outbox.put(("file", ctx, str(filepath)))
+        queued.set()
+        await asyncio.Event().wait()  # Download ancora in corso
+
+    monkeypatch.setattr(bot, "fetch_item", fetch_item)
+    message = fake_message()
+
+    async def run():
+        task = asyncio.create_task(bot.process_request(message, None, [bot.RequestContext("https://www.instagram.com/p/test/", False)]))
+        await queued.wait()
+        await asyncio.sleep(0.2)  # I file raggiungono il media group della pipeline
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    message.reply_media_group.assert_not_called()
+    assert os.path.exists(tmp_path / "0.jpg")  # I file restano per la ripresa del job
+
+def test_canonical_key_same_video():
+    keys = {bot.canonical_key(url) for url in (
+        "https://www.youtube.com/watch?v=dQw4w9WgXcQ&si=abc",
+        "https://youtu.be/dQw4w9WgXcQ?si=x",
+        "https://youtube.com/shorts/dQw4w9WgXcQ",
+        "https://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ",
+    )}
+    assert keys == {"youtube:dQw4w9WgXcQ"}
+    assert bot.canonical_key("https://www.instagram.com/reel/C1abc/?igsh=zz") == "instagram:C1abc"
+    assert bot.canonical_key("https://x.com/jack/status/20?s=20") == bot.canonical_key("https://twitter.com/jack/status/20")
+
+def test_canonical_key_keeps_playlists():
+    video = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+    playlist = "https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PLx"
+    assert bot.canonical_key(playlist) != bot.canonical_key(video)
+    assert bot.canonical_key("https://youtu.be/dQw4w9WgXcQ?list=PLx&si=a") == bot.canonical_key("https://youtu.be/dQw4w9WgXcQ?list=PLx")
+    assert bot.extract_urls(f"{video} {playlist}") == [video, playlist]
+    assert bot.RequestContext(playlist, False).cache_key() != bot.RequestContext(video, False).cache_key()
+
+def test_chat_busy_while_its_job_runs(tmp_path):
+    """Il job successivo di una chat non parte finché il precedente è in esecuzione (risposte in ordine)."""
+    queue = bot.JobQueue(str(tmp_path / "jobs.sqlite3"))
+    first = queue.enqueue(10, 10, {"urls": ["https://a.example/1"], "is_audio": False})
+    queue.enqueue(10, 10, {"urls": ["https://a.example/2"], "is_audio": False})
+    queue.enqueue(20, 20, {"urls": ["https://a.example/3"], "is_audio": False})
+    assert queue.claim(first, "worker", 60)
+    queue.set_state(first, bot.JOB_DOWNLOADING)
+    jobs, _, busy = queue.queued()
+    assert busy == {10}
+    queue.set_state(first, bot.JOB_DONE)
+    assert queue.queued()[2] == set()
+
+def test_resumed_job_skips_delivered_items(tmp_path, monkeypatch):
+    fetched = []
+
+    async def fetch_item(ctx, outbox, progress, label=None, stream=False):
+        fetched.append(ctx.item)
+        await outbox.put(("end", ctx, None))
+
+    monkeypatch.setattr(bot, "fetch_item", fetch_item)
+    monkeypatch.setattr(bot, "react", mock.AsyncMock())
+    queue = bot.JobQueue(str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(bot, "job_queue", queue)
+    urls = [f"https://www.instagram.com/p/test{i}/" for i in range(3)]
+    job_id = queue.enqueue(1, 1, {"urls": urls, "is_audio": False})
+    contexts = [bot.RequestContext(url, False, job_id=job_id) for url in urls]
+
+    assert asyncio.run(bot.process_request(fake_message(), None, contexts, delivered={0, 2}))
+    assert fetched == [1]
+    row = queue._connect().execute("SELECT payload FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    assert json.loads(row["payload"])["sent"] == [1]
+
+def fake_split(layout):
+    """split_video finto: `layout` associa al nome del file le dimensioni delle parti prodotte."""
+    async def split_video(filepath, limit, duration=None):
+        sizes = layout[os.path.basename(filepath)]
+        for i, size in enumerate(sizes):
+            part = f"{os.path.splitext(filepath)[0]}.part{i:03d}.mp4"
+            with open(part, "wb") as f:
+                f.write(b"\0" * size)
+            yield part, len(sizes)
+    return split_video
+
+async def collect(agen):
+    return [item async for item in agen]
+
+def test_split_resplits_parts_over_limit(tmp_path, monkeypatch):
+    source = tmp_path / "video.mp4"
+    source.write_bytes(b"\0" * 250)
+    monkeypatch.setattr(bot, "split_video", fake_split({"video.mp4": [50, 150, 50], "video.part001.mp4": [75, 75]}))
+    parts = asyncio.run(collect(bot.split_video_within(str(source), 100)))
+    assert [(os.path.basename(path), total) for path, total in parts] == [
+        ("video.part000.mp4", 3), ("video.part001.part000.mp4", 4), ("video.part001.part001.mp4", 4), ("video.part002.mp4", 4),
+    ]
+    assert all(os.path.getsize(path) <= 100 for path, _ in parts)
+    assert not os.path.exists(tmp_path / "video.part001.mp4")
+
+def test_split_fails_when_keyframes_are_too_sparse(tmp_path, monkeypatch):
+    source = tmp_path / "video.mp4"
+    source.write_bytes(b"\0" * 150)
+    layout = {"video.mp4": [150], "video.part000.mp4": [150], "video.part000.part000.mp4": [150]}
+    monkeypatch.setattr(bot, "split_video", fake_split(layout))
+    with pytest.raises(bot.ItemError, match="keyframe"):
+        asyncio.run(collect(bot.split_video_within(str(source), 100)))
+
+def test_thumbnail_falls_back_to_seek_with_sparse_keyframes(tmp_path, monkeypatch):
+    """Con keyframe radi il passaggio di remux non produce la miniatura: viene estratta con -ss."""
+    video = tmp_path / "video.mp4"
+    video.write_bytes(b"mdat")
+    commands = []
+
+    async def run_command(cmd):
+        commands.append(cmd)
+        if "-skip_frame" in cmd:
+            (tmp_path / "video.faststart.mp4").write_bytes(b"moov")  # Remux riuscito, nessun fotogramma selezionato
+        else:
+            (tmp_path / "video.thumb.jpg").write_bytes(b"jpg")
+        return 0, "", ""
+
+    monkeypatch.setattr(bot, "probe_media", mock.AsyncMock(return_value={"width": 1280, "height": 720, "duration": 60}))
+    monkeypatch.setattr(bot, "moov_at_start", lambda filepath: False)
+    monkeypatch.setattr(bot, "run_command", run_command)
+    meta = asyncio.run(bot.prepare_video(str(video)))
+    assert meta["thumbnail"] == str(tmp_path / "video.thumb.jpg")
+    assert len(commands) == 2 and "-ss" in commands[1]
+    assert video.read_bytes() == b"moov"
+
+def thread_engine():
+    """Motore in-process con un pool di thread al posto dei processi: gli stub restano visibili al "worker"."""
+    engine = bot.InProcessEngine(1)
+    engine.pool = ThreadPoolExecutor(1)
+    engine.manager = SimpleNamespace(Queue=queue.Queue)
+    return engine
+
+def stub_gallery_dl(monkeypatch, paths):
+    """gallery_dl finto per il motore in-process: il job "scarica" `paths` e la configurazione viene registrata."""
+    settings = {}
+
+    class DownloadJob:
+        def __init__(self, url):
+            self.url = url
+
+        def run(self):
+            out = output.select()
+            for path in paths:
+                out.success(path)
+            return 0
+
+    output = SimpleNamespace(NullOutput=object, select=None)
+    config = SimpleNamespace(clear=settings.clear, set=lambda path, key, value: settings.__setitem__(key, value))
+    package = SimpleNamespace(config=config, job=SimpleNamespace(DownloadJob=DownloadJob), output=output)
+    for name, module in (("gallery_dl", package), ("gallery_dl.config", config), ("gallery_dl.job", package.job), ("gallery_dl.output", output)):
+        monkeypatch.setitem(sys.modules, name, module)
+    return settings
+
+def test_inprocess_gallery_download_passes_events_and_skip(tmp_path, monkeypatch):
+    settings = stub_gallery_dl(monkeypatch, ["/w/a.jpg", "/w/b.jpg"])
+    engine = thread_engine()
+    events = []
+
+    async def on_event(event):
+        events.append(event)
+
+    try:
+        error = asyncio.run(engine.download_gallery("https://www.instagram.com/p/test/", str(tmp_path), on_event, skip=4))
+    finally:
+        engine.pool.shutdown()
+    assert error is None
+    assert events == [("file", None, "/w/a.jpg"), ("file", None, "/w/b.jpg")]
+    assert settings["image-range"] == "5-"
+
+def test_engine_callback_errors_are_not_engine_failures():
+    """Un errore di on_event (es. invio a Telegram) non deve far ripiegare sui comandi mentre il pool scarica ancora."""
+    def download(events):
+        events.put(("file", None, "/w/a.mp4"))
+        events.put(None)
+
+    async def on_event(event):
+        raise RuntimeError("invio non riuscito")
+
+    engine = thread_engine()
+    try:
+        with pytest.raises(RuntimeError, match="invio non riuscito"):
+            asyncio.run(engine._call(download, on_event=on_event))
+    finally:
+        engine.pool.shutdown()
+
+def test_engine_pool_failures_are_engine_unavailable():
+    def download(events):
+        raise BrokenProcessPool("processo terminato")
+
+    engine = thread_engine()
+    try:
+        with pytest.raises(bot.EngineUnavailable):
+            asyncio.run(engine._call(download))
+    finally:
+        engine.pool.shutdown()
+
+def test_item_counted_once_in_file_id_cache_stats(monkeypatch):
+    """Un link già cercato nella cache alla ricezione del messaggio non conta un secondo miss nel job."""
+    monkeypatch.setattr(bot, "download_content", mock.AsyncMock(return_value=[]))
+
+    def misses_after_fetch(cache_checked):
+        ctx = bot.RequestContext("https://www.instagram.com/p/uncached/", False)
+        ctx.cache_checked = cache_checked
+        before = bot.file_id_cache.misses
+        outbox = asyncio.Queue()
+        asyncio.run(bot.fetch_item(ctx, outbox, None))
+        return bot.file_id_cache.misses - before
+
+    assert misses_after_fetch(True) == 0
+    assert misses_after_fetch(False) == 1
+
+def test_cache_hit_waits_for_earlier_jobs_of_the_chat(tmp_path, monkeypatch):
+    """Un link in cache inviato dopo uno ancora in coda nella stessa chat viene accodato, non inviato subito."""
+    queue_ = bot.JobQueue(str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(bot, "job_queue", queue_)
+    monkeypatch.setattr(bot, "react", mock.AsyncMock())
+    send_from_cache = mock.AsyncMock(return_value=True)
+    monkeypatch.setattr(bot, "send_from_cache", send_from_cache)
+    monkeypatch.setattr(bot.dispatcher, "notify", lambda: None)
+
+    def update(message_id, url):
+        return SimpleNamespace(message=SimpleNamespace(
+            text=url, chat=SimpleNamespace(id=1), from_user=SimpleNamespace(id=1), message_id=message_id,
+            to_dict=lambda: {"message_id": message_id},
+        ))
+
+    asyncio.run(bot.handle_message(update(1, "https://a.example/cached"), SimpleNamespace(bot=None)))
+    send_from_cache.assert_awaited_once()
+    queue_.enqueue(1, 1, {"urls": ["https://a.example/slow"], "is_audio": False})
+    asyncio.run(bot.handle_message(update(2, "https://a.example/cached"), SimpleNamespace(bot=None)))
+    send_from_cache.assert_awaited_once()
+    jobs = queue_.queued()[0]
+    assert [job["payload"]["urls"] for job in jobs] == [["https://a.example/slow"], ["https://a.example/cached"]]
+    assert jobs[1]["payload"]["cache_checked"] is False
+
+def test_instagram_post_video_caption_uses_post_metadata(monkeypatch):
+    """I video dei post di Instagram hanno la didascalia dai metadati del post, estratti una sola volta."""
+    url = "https://www.instagram.com/p/carousel/"
+    post = {"_type": "playlist", "id": "carousel", "extractor": "Instagram",
+            "entries": [{"id": "1", "uploader": "autore", "description": "Didascalia del post", "duration": 5}]}
+    run_command = mock.AsyncMock(return_value=(0, json.dumps(post), ""))
+    monkeypatch.setattr(bot, "run_command", run_command)
+    monkeypatch.setattr(bot, "PREPARE_VIDEOS", True)
+    monkeypatch.setattr(bot, "prepare_video", mock.AsyncMock(return_value={"duration": 75}))
+
+    async def download_content(ctx, on_file=None, on_progress=None):
+        files = ["/w/a.jpg", "/w/b.mp4", "/w/c.mp4"]
+        for filepath in files:
+            await on_file(filepath)
+        return files
+    monkeypatch.setattr(bot, "download_content", download_content)
+
+    ctx = bot.RequestContext(url, False)
+    asyncio.run(bot.fetch_item(ctx, asyncio.Queue(), None))
+    assert run_command.await_count == 1
+    caption = bot.build_video_caption(ctx.entry_info("/w/c.mp4"), url)
+    assert "autore" in caption and "Didascalia del post" in caption and "1:15" in caption